@@ -32,3 +32,54 @@ def interp(x, y, xs, ind):
     ))
 
     return sum(map(lambda i: coefficients[i] * items[i], range(4)))
+
+
+def interp_matrix(x, xs, ind):
+    """
+    Precompile ``interp`` for fixed sampling positions into a sparse linear operator,
+    so that interpolating any y sampled on x becomes a single sparse matrix multiplication.
+    Each output sample depends on at most four neighbouring nodes, ind - 1 to ind + 2,
+    through the node values and the averaged secant slopes.
+    x: n x N, xs: n x h x w, ind: n x h x w
+    Returns a block diagonal sparse matrix in shape nhw x nN, the i-th block for the i-th row of x.
+    """
+    n, size = x.shape
+    ind = ind.to(x.device).reshape(n, -1)
+    dx = x[:, [1]] - x[:, [0]]
+    t = (xs.reshape(n, -1) - torch.gather(x, 1, ind)) / dx
+    h00, h10, h01, h11 = __poly_coeff(t)
+
+    # slope at each node as combination of its neighbours (offset -1, 0, +1)
+    g = 1 / ((x[:, 1:] - x[:, :-1]) * dx)  # n x (N - 1)
+    zero = torch.zeros_like(g[:, :1])
+    slope = torch.stack([
+        torch.cat([zero, -g[:, :-1] / 2, -g[:, -1:]], -1),
+        torch.cat([-g[:, :1], (g[:, :-1] - g[:, 1:]) / 2, g[:, -1:]], -1),
+        torch.cat([g[:, :1], g[:, 1:] / 2, zero], -1)
+    ], -1)  # n x N x 3
+
+    s0 = slope[torch.arange(n, device=x.device)[:, None], ind]  # n x hw x 3
+    s1 = slope[torch.arange(n, device=x.device)[:, None], ind + 1]
+    weights = torch.stack([
+        h01 * s0[..., 0],
+        h00 + h01 * s0[..., 1] + h11 * s1[..., 0],
+        h10 + h01 * s0[..., 2] + h11 * s1[..., 1],
+        h11 * s1[..., 2]
+    ], -1)  # n x hw x 4
+
+    offset = torch.arange(-1, 3, device=x.device)
+    cols = torch.clamp(ind[..., None] + offset, 0, size - 1) + size * torch.arange(n, device=x.device)[:, None, None]
+    rows = torch.arange(n * ind.shape[1], device=x.device).reshape(n, -1, 1).expand_as(cols)
+    return torch.sparse_coo_tensor(
+        torch.stack([rows.flatten(), cols.flatten()]), weights.flatten(), (rows.numel() // 4, n * size)
+    ).coalesce()
+
+
+def interp_with_matrix(mat, y, size):
+    """
+    Apply an operator given by ``interp_matrix`` to y in shape n x D x N, supporting autograd w.r.t. y.
+    Returns n x D x h x w where (h, w) = size.
+    """
+    n, d, _ = y.shape
+    res = torch.sparse.mm(mat, y.transpose(0, 1).reshape(d, -1).t())  # nhw x D
+    return res.t().reshape(d, n, *size).transpose(0, 1)
@@ -1,7 +1,9 @@
+import functools
 import warnings
 
 import torch
 
+import utils
 import utils.fft as fft
 import utils.old_complex as old_complex
 
@@ -28,21 +30,21 @@ def __old_image_formation(volume, layered_mask, psf, occlusion=True, eps=1e-3):
     """
     scale = volume.max()
     volume = volume / scale
-    f_psf = torch.rfft(psf, 2)
-    f_volume = torch.rfft(volume, 2)
+    f_psf = fft.old_rfft(psf, 2)
+    f_volume = fft.old_rfft(volume, 2)
 
     if occlusion:
         with torch.no_grad():
-            f_layered_depth = torch.rfft(layered_mask, 2)
+            f_layered_depth = fft.old_rfft(layered_mask, 2)
             cumsum_alpha = torch.flip(torch.cumsum(torch.flip(layered_mask, dims=(-3,)), dim=-3), dims=(-3,))
-            f_cumsum_alpha = torch.rfft(cumsum_alpha, 2)
+            f_cumsum_alpha = fft.old_rfft(cumsum_alpha, 2)
 
-        blurred_alpha_rgb = torch.irfft(
+        blurred_alpha_rgb = fft.old_irfft(
             old_complex.multiply(f_layered_depth, f_psf), 2, signal_sizes=volume.shape[-2:])
-        blurred_volume = torch.irfft(
+        blurred_volume = fft.old_irfft(
             old_complex.multiply(f_volume, f_psf), 2, signal_sizes=volume.shape[-2:])
 
-        blurred_cumsum_alpha = torch.irfft(
+        blurred_cumsum_alpha = fft.old_irfft(
             old_complex.multiply(f_cumsum_alpha, f_psf), 2, signal_sizes=volume.shape[-2:])
         blurred_volume = blurred_volume / (blurred_cumsum_alpha + eps)
         blurred_alpha_rgb = blurred_alpha_rgb / (blurred_cumsum_alpha + eps)
@@ -51,11 +53,195 @@ def __old_image_formation(volume, layered_mask, psf, occlusion=True, eps=1e-3):
         captimg = torch.sum(over_alpha * blurred_volume, dim=-3)
     else:
         f_captimg = old_complex.multiply(f_volume, f_psf).sum(dim=2)
-        captimg = torch.irfft(f_captimg, 2, signal_sizes=volume.shape[-2:])
+        captimg = fft.old_irfft(f_captimg, 2, signal_sizes=volume.shape[-2:])
 
     captimg = scale * captimg
     volume = scale * volume
     return fft.fftshift(captimg), fft.fftshift(volume)
 
 
-image_formation = __old_image_formation
+def __native_image_formation(volume, layered_mask, psf, occlusion=True, eps=1e-3):
+    """
+    The same model as ``__old_image_formation`` computed with complex tensors on half spectrum.
+    Volume, mask and cumulative alpha are transformed by a single batched real FFT, and mask and
+    cumulative alpha are blurred by another one. The PSF spectrum is shared across the batch and
+    carries ``fftshift`` as a phase factor. No rescaling of volume is needed as the model is linear in it.
+    """
+    size = volume.shape[-2:]
+    c = volume.shape[1]
+    f_psf = fft.rfft2(psf)
+    f_psf = f_psf * fft.rfft_shift(size, f_psf.device, f_psf.dtype)
+
+    if occlusion:
+        with torch.no_grad():
+            cumsum_alpha = torch.flip(torch.cumsum(torch.flip(layered_mask, dims=(-3,)), dim=-3), dims=(-3,))
+        f_inputs = fft.rfft2(torch.cat([volume, layered_mask, cumsum_alpha], 1))
+        f_volume, f_alpha = torch.split(f_inputs, [c, 2], 1)
+
+        # mask and cumulative alpha are blurred together, each by PSF of every color channel
+        blurred_volume = fft.irfft2(f_volume * f_psf, size)
+        blurred_alpha_rgb, blurred_cumsum_alpha = fft.irfft2(f_alpha.unsqueeze(2) * f_psf.unsqueeze(1), size).unbind(1)
+        blurred_volume = blurred_volume / (blurred_cumsum_alpha + eps)
+        blurred_alpha_rgb = blurred_alpha_rgb / (blurred_cumsum_alpha + eps)
+
+        over_alpha = _over_op(blurred_alpha_rgb)
+        captimg = torch.sum(over_alpha * blurred_volume, dim=-3)
+    else:
+        captimg = fft.irfft2((fft.rfft2(volume) * f_psf).sum(dim=2), size)
+
+    return captimg, fft.fftshift(volume)
+
+
+@torch.no_grad()
+def occupied_layers(layered_mask) -> torch.Tensor:
+    """
+    Find depth layers covered by any pixel of any image in a batch. Empty layers contribute
+    nothing to captured image and leave cumulative alpha of other layers unchanged,
+    so image formation on occupied layers only gives the same result.
+    :param layered_mask: Mask with shape B x 1 x D x H x W
+    :return: Indices of occupied layers
+    """
+    return torch.nonzero(layered_mask.sum(dim=(0, 1, 3, 4))).flatten()
+
+
+def image_formation(volume, layered_mask, psf, occlusion=True, backend='native', eps=1e-3):
+    if backend == 'legacy':
+        return __old_image_formation(volume, layered_mask, psf, occlusion, eps)
+    return __native_image_formation(volume, layered_mask, psf, occlusion, eps)
+
+
+@torch.no_grad()
+def support_radius(psf, tol=1e-4) -> int:
+    """
+    Estimate half size r of the smallest square window centered at (H // 2, W // 2)
+    which holds at least 1 - tol of energy of every PSF.
+    :param psf: PSF with shape ... x H x W
+    :param tol: Fraction of energy allowed outside the window
+    :return: r such that the window is (2r + 1) x (2r + 1)
+    """
+    h, w = psf.shape[-2:]
+    ch, cw = h // 2, w // 2
+    r_max = min(ch, h - 1 - ch, cw, w - 1 - cw)
+
+    energy = psf.reshape(-1, h, w).double()
+    energy = energy / energy.sum((-2, -1), keepdim=True)
+    integral = torch.nn.functional.pad(energy.cumsum(-2).cumsum(-1), [1, 0, 1, 0])
+    r = torch.arange(r_max + 1, device=psf.device)
+    captured = integral[:, ch + r + 1, cw + r + 1] - integral[:, ch - r, cw + r + 1] \
+        - integral[:, ch + r + 1, cw - r] + integral[:, ch - r, cw - r]
+    enough = (captured.min(0)[0] >= 1 - tol).nonzero()
+    return int(enough[0]) if len(enough) else r_max
+
+
+def __blur_tile(f_psf, k, volume, layered_mask, cumsum_alpha, occlusion, eps):
+    size = volume.shape[-2:]
+    if occlusion:
+        f_volume, f_alpha = torch.split(fft.rfft2(torch.cat([volume, layered_mask, cumsum_alpha], 1)), [volume.shape[1], 2], 1)
+        blurred_volume = fft.irfft2(f_volume * f_psf, size)[..., k - 1:, k - 1:]
+        blurred_alpha_rgb, blurred_cumsum_alpha = fft.irfft2(
+            f_alpha.unsqueeze(2) * f_psf.unsqueeze(1), size
+        )[..., k - 1:, k - 1:].unbind(1)
+        blurred_volume = blurred_volume / (blurred_cumsum_alpha + eps)
+        blurred_alpha_rgb = blurred_alpha_rgb / (blurred_cumsum_alpha + eps)
+        return torch.sum(_over_op(blurred_alpha_rgb) * blurred_volume, dim=-3)
+    else:
+        return fft.irfft2((fft.rfft2(volume) * f_psf).sum(dim=2), size)[..., k - 1:, k - 1:]
+
+
+def tiled_image_formation(volume, layered_mask, psf, occlusion=True, eps=1e-3, tile=256, tol=1e-4):
+    """
+    The same model as ``image_formation`` with PSF cropped to its energy support and convolution
+    done by overlap-save tiling, so that spectra are only as large as a tile plus PSF support.
+    Each tile is recomputed in backward pass rather than keeping its spectra.
+    :param tile: Size of output tiles, adjusted so that FFT size is 5-smooth
+    :param tol: Fraction of PSF energy allowed to be discarded, see ``support_radius``
+    :return: Captured image and volume with the same layout as ``image_formation``
+    """
+    h, w = volume.shape[-2:]
+    r = support_radius(psf, tol)
+    k = 2 * r + 1
+    n = fft.next_fast_len(min(tile, max(h, w)) + k - 1)
+    t = n - k + 1
+
+    # tile window j covers volume[n0 + o - r + j] (mod size), where o absorbs the double fftshift
+    with torch.no_grad():
+        cumsum_alpha = torch.flip(torch.cumsum(torch.flip(layered_mask, dims=(-3,)), dim=-3), dims=(-3,))
+    inputs = [volume, layered_mask, cumsum_alpha] if occlusion else [volume]
+    for dim, size in ((-2, h), (-1, w)):
+        index = torch.arange(n + size, device=volume.device) + (-2 * (size // 2)) % size - r
+        inputs = [x.index_select(dim, index % size) for x in inputs]
+    if not occlusion:
+        inputs += [None, None]
+
+    ch, cw = h // 2, w // 2
+    f_psf = fft.rfft2(torch.nn.functional.pad(psf[..., ch - r:ch + r + 1, cw - r:cw + r + 1], [0, n - k, 0, n - k]))
+    blur = functools.partial(__blur_tile, occlusion=occlusion, eps=eps)
+
+    rows = []
+    for y in range(0, h, t):
+        row = []
+        for x in range(0, w, t):
+            windows = [None if v is None else v[..., y:y + n, x:x + n] for v in inputs]
+            if torch.is_grad_enabled() and f_psf.requires_grad:
+                captimg = utils.checkpoint(blur, f_psf, k, *windows)
+            else:
+                captimg = blur(f_psf, k, *windows)
+            row.append(captimg[..., :min(t, h - y), :min(t, w - x)])
+        rows.append(torch.cat(row, -1))
+    return torch.cat(rows, -2), fft.fftshift(volume)
+
+
+def __blur_labeled_layers(f_psf, img, labels, weight, index, occlusion, eps):
+    size = img.shape[-2:]
+    with torch.no_grad():
+        layered_mask = utils.labels2layers(labels, index, weight, dtype=img.dtype)
+        volume = layered_mask * img[:, :, None, ...]
+    if not occlusion:
+        return (fft.rfft2(volume) * f_psf).sum(dim=2)
+
+    with torch.no_grad():
+        cumsum_alpha = utils.labels2layers(labels, index, weight, cumulative=True, dtype=img.dtype)
+    f_volume, f_alpha = torch.split(fft.rfft2(torch.cat([volume, layered_mask, cumsum_alpha], 1)), [img.shape[1], 2], 1)
+    blurred_volume = fft.irfft2(f_volume * f_psf, size)
+    blurred_alpha_rgb, blurred_cumsum_alpha = fft.irfft2(f_alpha.unsqueeze(2) * f_psf.unsqueeze(1), size).unbind(1)
+    return blurred_volume / (blurred_cumsum_alpha + eps), blurred_alpha_rgb / (blurred_cumsum_alpha + eps)
+
+
+def labeled_image_formation(img, labels, psf, occlusion=True, eps=1e-3, weight=None, chunk=4):
+    """
+    The same model as ``image_formation`` with scene given by layer labels from ``utils.depthmap2labels``,
+    so that neither dense alpha nor volume is materialized. Only occupied layers are expanded to
+    one-hot, a chunk of them at a time, and compositing is carried across chunks by transmittance
+    of the layers in front. Spectra of each chunk are recomputed in backward pass rather than kept.
+    It is computed with native complex tensors regardless of complex backend.
+    :param img: All-in-focus image with shape B x C x H x W
+    :param labels: Layer labels with shape B x 1 x H x W
+    :param psf: PSF with shape 1 x C x D x H x W
+    :param weight: Fractional weight of layer in front of labelled one, optional
+    :param chunk: Number of layers transformed at a time
+    :return: Captured image with shape B x C x H x W
+    """
+    size = img.shape[-2:]
+    blur = functools.partial(__blur_labeled_layers, occlusion=occlusion, eps=eps)
+
+    captimg = 0
+    transmittance = 1
+    for index in torch.split(utils.occupied_labels(labels, weight), chunk):
+        f_psf = fft.rfft2(psf.index_select(2, index.to(psf.device)))
+        f_psf = f_psf * fft.rfft_shift(size, f_psf.device, f_psf.dtype)
+        if torch.is_grad_enabled() and f_psf.requires_grad:
+            blurred = utils.checkpoint(blur, f_psf, img, labels, weight, index)
+        else:
+            blurred = blur(f_psf, img, labels, weight, index)
+
+        if occlusion:
+            blurred_volume, blurred_alpha_rgb = blurred
+            over_alpha = transmittance * _over_op(blurred_alpha_rgb)
+            captimg = captimg + torch.sum(over_alpha * blurred_volume, dim=-3)
+            transmittance = transmittance * torch.prod(1. - blurred_alpha_rgb, dim=-3, keepdim=True)
+        else:
+            captimg = captimg + blurred
+
+    if not occlusion:
+        captimg = fft.irfft2(captimg, size)
+    return captimg
@@ -77,21 +77,45 @@ def __old_tikhonov_inverse_closed_form(
         dim=-1)
 
 
+def __tikhonov_inverse_closed_form(
+    y: torch.Tensor, g: torch.Tensor, gamma=0.1
+) -> torch.Tensor:
+    r"""
+    The same approximate inverse as ``__old_tikhonov_inverse_closed_form`` computed
+    with complex tensors. As there is a single shot, the inverse of
+    :math:`\gamma I+gg^H` is applied by Sherman-Morrison formula without any matrix product.
+    :param y: Spectrum of captured image with shape B x C x 1 x H x W
+    :param g: Spectrum of PSF with shape 1 x C x 1 x D x H x W
+    :param gamma: Regularization factor
+    :return: Approximate inversed volume spectrum with shape B x C x D x H x W
+    """
+    if g.shape[2] != 1:
+        raise NotImplementedError('It should not reach here')
+
+    g = g.squeeze(2)
+    gc_y = g.conj() * y
+    innerprod = myfft.abs2(g).sum(dim=2, keepdim=True)
+    projection = (g.conj() * gc_y).sum(dim=2, keepdim=True)
+    return (gc_y - g * projection / (gamma + innerprod)) / gamma
+
+
 def tikhonov_inverse(
-    capt_img: torch.Tensor, psf: torch.Tensor, regularizer: float, edge_taper=True
+    capt_img: torch.Tensor, psf: torch.Tensor, regularizer: float, edge_taper=True, backend='native'
 ) -> torch.Tensor:
     if edge_taper:
         capt_img = __edgetaper3d(capt_img, psf)
 
-    # est_x_ft = __tikhonov_inverse_closed_form(
-    #     myfft.rfft2(capt_img).unsqueeze(2),
-    #     myfft.rfft2(psf).unsqueeze(2),
-    #     gamma=regularizer
-    # )
-    # return fft.irfftn(est_x_ft, capt_img.shape[-2:])
-    est_x_ft = __old_tikhonov_inverse_closed_form(
-        torch.rfft(capt_img, 2).unsqueeze(2),
-        torch.rfft(psf, 2).unsqueeze(2),
+    if backend == 'legacy':
+        est_x_ft = __old_tikhonov_inverse_closed_form(
+            myfft.old_rfft(capt_img, 2).unsqueeze(2),
+            myfft.old_rfft(psf, 2).unsqueeze(2),
+            gamma=regularizer
+        )
+        return myfft.fftshift(myfft.old_irfft(est_x_ft, 2, signal_sizes=capt_img.shape[-2:]))
+
+    est_x_ft = __tikhonov_inverse_closed_form(
+        myfft.rfft2(capt_img).unsqueeze(2),
+        myfft.rfft2(psf).unsqueeze(2),
         gamma=regularizer
     )
-    return myfft.fftshift(torch.irfft(est_x_ft, 2, signal_sizes=capt_img.shape[-2:]))
+    return myfft.fftshift(myfft.irfft2(est_x_ft, capt_img.shape[-2:]))
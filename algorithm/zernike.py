@@ -1,4 +1,6 @@
+import collections
 import functools
+import typing
 
 import torch
 
@@ -14,11 +16,76 @@ def fit_with_matrix(mat: torch.Tensor, c: torch.Tensor, size=None) -> torch.Tens
     return res
 
 
-def make_matrix(r: torch.Tensor, theta: torch.Tensor, k: int) -> torch.Tensor:
-    cnt = (k + 1) * (k + 2) // 2
-    values = [torch.flatten(
-        zernike_basis(r, theta, *convert_index(i)), -2, -1
-    ) for i in range(cnt)]
+# bound of total bytes of cached matrices, beyond which least recently used ones are dropped;
+# a matrix larger than it is not cached at all
+matrix_cache_bytes = 256 * 2 ** 20
+__matrix_cache = collections.OrderedDict()
+
+
+def make_matrix(r: torch.Tensor, theta: torch.Tensor, k: int, grid: typing.Hashable = None) -> torch.Tensor:
+    """
+    Evaluate Zernike polynomials up to degree k on a polar grid. Matrices of grids identified by ``grid``
+    are kept in an LRU cache keyed by it, degree, dtype and device and bounded by ``matrix_cache_bytes``,
+    so the returned tensor must not be modified in place.
+    :param r: Radial coordinates in shape ... x H x W
+    :param theta: Angular coordinates broadcastable with ``r``
+    :param k: Maximum degree
+    :param grid: Parameters the grid is built from, e.g. its kind, size and extent, not cached if None
+    :return: Matrix in shape ... x HW x (k+1)(k+2)/2
+    """
+    if grid is None:
+        return generate_matrix(r, theta, k)
+
+    key = (k, grid, r.dtype, str(r.device))
+    if key in __matrix_cache:
+        __matrix_cache.move_to_end(key)
+        return __matrix_cache[key]
+
+    mat = generate_matrix(r, theta, k)
+    if __nbytes(mat) > matrix_cache_bytes:
+        return mat
+    __matrix_cache[key] = mat
+    while sum(map(__nbytes, __matrix_cache.values())) > matrix_cache_bytes:
+        __matrix_cache.popitem(last=False)
+    return mat
+
+
+def clear_matrix_cache():
+    __matrix_cache.clear()
+
+
+def __nbytes(x: torch.Tensor) -> int:
+    return x.numel() * x.element_size()
+
+
+def generate_matrix(r: torch.Tensor, theta: torch.Tensor, k: int) -> torch.Tensor:
+    r"""
+    Evaluate all Zernike polynomials up to degree k in one pass, column ordered as ``convert_index``.
+    Radial polynomials are built by the recurrence
+    :math:`R_n^m=r(R_{n-1}^{|m-1|}+R_{n-1}^{m+1})-R_{n-2}^m` with :math:`R_n^n=r^n`
+    and angular terms by :math:`\cos k\theta=2\cos\theta\cos(k-1)\theta-\cos(k-2)\theta`
+    (likewise for sine), so powers of r and harmonics are shared across all orders.
+    """
+    r, theta = torch.broadcast_tensors(r, theta)
+    r = torch.flatten(r, -2, -1)
+    theta = torch.flatten(theta, -2, -1)
+
+    radial = {(0, 0): torch.ones_like(r)}
+    for n in range(1, k + 1):
+        radial[n, n] = r * radial[n - 1, n - 1]
+        for m in range(n % 2, n - 1, 2):
+            radial[n, m] = r * (radial[n - 1, abs(m - 1)] + radial[n - 1, m + 1]) - radial[n - 2, m]
+
+    cos, sin = [torch.ones_like(theta), torch.cos(theta)], [torch.zeros_like(theta), torch.sin(theta)]
+    for m in range(2, k + 1):
+        cos.append(2 * cos[1] * cos[m - 1] - cos[m - 2])
+        sin.append(2 * cos[1] * sin[m - 1] - sin[m - 2])
+
+    values = []
+    for i in range((k + 1) * (k + 2) // 2):
+        n, m = convert_index(i)
+        m = n - 2 * m
+        values.append(radial[n, abs(m)] * (cos[m] if m >= 0 else sin[-m]))
     return torch.stack(values, -1)
 
 
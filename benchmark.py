@@ -0,0 +1,197 @@
+import argparse
+import functools
+import time
+
+import torch
+from torch.autograd import profiler
+from tabulate import tabulate
+
+import algorithm.image
+import algorithm.inverse
+import optics
+import utils
+import utils.fft as fft
+
+
+def measure(fn, device, repeat=5):
+    """
+    Measure average running time and peak memory of a stage.
+    Peak memory is given by CUDA allocator on GPU and by memory profiler on CPU.
+    :param fn: Stage to be measured
+    :param device: Device on which the stage runs
+    :param repeat: Number of repetition for timing
+    :return: Time in milliseconds, peak memory in MiB
+    """
+    fn()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = (time.perf_counter() - start) / repeat * 1e3
+
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device) - base
+    else:
+        with profiler.profile(profile_memory=True) as prof:
+            fn()
+        peak = current = 0
+        for event in sorted(prof.function_events, key=lambda e: e.time_range.start):
+            current += event.self_cpu_memory_usage
+            peak = max(peak, current)
+    return elapsed, peak / 2 ** 20
+
+
+def complex_stages(args, device):
+    n_wl, d, n = 3, args.n_depths, args.pupil_sz
+    b, h = args.batch_sz, args.image_sz
+    amplitude = torch.rand(n_wl, d, n, n, device=device)
+    phase = (100 * torch.rand(n_wl, d, n, n, device=device)).requires_grad_()
+
+    depthmap = torch.rand(b, 1, h, h, device=device)
+    img = torch.rand(b, 3, h, h, device=device)
+    layered_mask = utils.depthmap2layers(depthmap, d, binary=True)
+    volume = layered_mask * img[:, :, None, ...]
+    psf = torch.rand(1, 3, d, h, h, device=device, requires_grad=True)
+
+    def psf_stage(backend):
+        fft.abs2(fft.fft2(fft.polar(amplitude, phase, backend), backend)).sum().backward()
+
+    def otf_stage(backend):
+        with torch.no_grad():
+            if backend == 'legacy':
+                otf = fft.old_rfft(psf, 2, onesided=False)
+            else:
+                otf = fft.fft2(psf)
+            fft.abs(otf)
+
+    def image_formation_stage(backend):
+        captimg, _ = algorithm.image.image_formation(volume, layered_mask, psf, True, backend)
+        captimg.sum().backward()
+
+    def inverse_stage(backend):
+        with torch.no_grad():
+            algorithm.inverse.tikhonov_inverse(img, psf, 0.1, False, backend)
+
+    return {
+        'psf (fwd+bwd)': psf_stage,
+        'otf/mtf': otf_stage,
+        'image formation (fwd+bwd)': image_formation_stage,
+        'tikhonov inverse': inverse_stage
+    }
+
+
+def complex_benchmark(args):
+    device = torch.device(args.device)
+    stages = complex_stages(args, device)
+    table = []
+    for name, stage in stages.items():
+        row = [name]
+        for backend in ('legacy', 'native'):
+            row += list(measure(functools.partial(stage, backend), device, args.repeat))
+        table.append(row)
+
+    print(tabulate(
+        table,
+        headers=['stage', 'legacy/ms', 'legacy/MiB', 'native/ms', 'native/MiB'],
+        floatfmt='.4g'
+    ))
+
+
+def psf_variant_benchmark(args, key, values, header):
+    """
+    Measure PSF of every classic camera constructed with each of ``values`` of hyperparameter ``key``,
+    whose errors are relative to the first value on the same optics.
+    """
+    device = torch.device(args.device)
+    table = []
+    for name, ct in optics.camera_dir.items():
+        if not issubclass(ct, optics.ClassicCamera) or ct in [row[-1] for row in table]:
+            continue
+        hparams = vars(ct.add_specific_args(argparse.ArgumentParser()).parse_args([]))
+        hparams.update({'image_sz': args.image_sz, 'crop_width': 0, 'n_depths': args.n_depths})
+
+        reference = None
+        for value in values:
+            hparams[key] = value
+            camera = optics.construct_camera(name, hparams).to(device)
+            if reference is None:
+                state = camera.state_dict()
+            camera.load_state_dict(state)
+
+            def psf_stage():
+                camera.zero_grad()
+                camera.psf(camera.scene_distances, True).sum().backward()
+
+            t, m = measure(psf_stage, device, args.repeat)
+            with torch.no_grad():
+                psf = camera.psf(camera.scene_distances, True).double()
+            if reference is None:
+                reference = psf
+            error = psf - reference
+            table.append([
+                name, value, t, m,
+                (error.abs().max() / reference.abs().max()).item(),
+                (error.norm() / reference.norm()).item(),
+                ct
+            ])
+
+    print(tabulate(
+        [row[:-1] for row in table],
+        headers=['camera', header, 'time/ms', 'peak/MiB', 'max rel. error', 'L2 rel. error'],
+        floatfmt='.4g'
+    ))
+
+
+def sensor_benchmark(args):
+    device = torch.device(args.device)
+    hparams = vars(optics.get_camera('b-spline').add_specific_args(argparse.ArgumentParser()).parse_args([]))
+    hparams.update({'image_sz': args.image_sz, 'crop_width': 0, 'n_depths': args.n_depths})
+    cameras = {}
+    for fused in (False, True):
+        hparams['fused_sensor'] = fused
+        cameras[fused] = optics.construct_camera('b-spline', hparams).to(device)
+
+    table = []
+    for batch_sz in (1, args.batch_sz, 4 * args.batch_sz):
+        img = torch.rand(batch_sz, 3, args.image_sz, args.image_sz, device=device, requires_grad=True)
+        row = [batch_sz]
+        for fused in (False, True):
+            def sensor_stage():
+                cameras[fused].apply_noise(img).sum().backward()
+
+            row += list(measure(sensor_stage, device, args.repeat))
+        table.append(row)
+
+    print(tabulate(
+        table,
+        headers=['batch', 'unfused/ms', 'unfused/MiB', 'fused/ms', 'fused/MiB'],
+        floatfmt='.4g'
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--type', type=str, default='complex')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--batch_sz', type=int, default=4)
+    parser.add_argument('--image_sz', type=int, default=384)
+    parser.add_argument('--pupil_sz', type=int, default=1024)
+    parser.add_argument('--n_depths', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.type == 'complex':
+        complex_benchmark(args)
+    elif args.type == 'precision':
+        psf_variant_benchmark(args, 'precision', optics.precisions, 'precision')
+    elif args.type == 'psf_mode':
+        psf_variant_benchmark(args, 'psf_mode', optics.psf_modes, 'PSF mode')
+    elif args.type == 'sensor':
+        sensor_benchmark(args)
+    else:
+        raise ValueError(f'Unknown benchmark type: {args.type}')
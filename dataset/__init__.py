@@ -1,3 +1,6 @@
-from dataset.img_transform import ImageItem
+from dataset.img_transform import ImageItem, LabeledImageItem, encode_item, decode_item
+from dataset.manifest import *
 from dataset.dualpixel import *
 from dataset.sceneflow import *
+from dataset.precoded import *
+from dataset.shards import *
@@ -1,8 +1,9 @@
 from typing import Tuple
+import functools
 import os
-import glob
 
 import torch
+import torch.nn.functional as functional
 import numpy as np
 import skimage.io
 import torch.utils.data as data
@@ -13,6 +14,7 @@ import skimage.transform as transform
 import dataset
 import dataset.img_transform
 import utils
+from dataset.manifest import load_manifest
 
 CROP_WIDTH = 20
 
@@ -28,8 +30,21 @@ class DualPixel(data.Dataset):
         random_crop: bool = False,
         augment: bool = False,
         padding: int = 0,
-        upsample_factor: int = 2
+        upsample_factor: int = 2,
+        n_depths: int = 16,
+        layer_labels: bool = False,
+        deferred_upsample: bool = False,
+        manifest_path: str = None,
+        compact: bool = False
     ):
+        """
+        :param deferred_upsample: Whether to crop samples at size reduced by upsample factor and leave
+            upsampling to ``UpsamplingCollate``, which upsamples collated samples in batch
+        :param manifest_path: Manifest file listing captures, see ``load_manifest``.
+            Defaults to ``.manifest.json`` in directory of the partition
+        :param compact: Whether to encode samples by ``encode_item`` for transport,
+            which requires confidence to be thresholded, i.e. no deferred upsampling
+        """
         super().__init__()
         if partition == 'train':
             self.__base_dir = os.path.join(dp_root, 'train')
@@ -38,24 +53,69 @@ class DualPixel(data.Dataset):
         else:
             raise ValueError(f'dataset ({partition}) has to be "train," "val," or "example."')
 
+        if deferred_upsample:
+            if compact:
+                raise ValueError('Unthresholded confidence of deferred upsampling cannot be encoded')
+            if image_size[0] % upsample_factor or image_size[1] % upsample_factor:
+                raise ValueError(f'Image size {image_size} is not divisible by upsample factor {upsample_factor}')
+            image_size = (image_size[0] // upsample_factor, image_size[1] // upsample_factor)
+            upsample_factor = 1
         self.__transform = dataset.img_transform.RandomTransform(image_size, random_crop, augment)
         self.__centercrop = augmentation.CenterCrop(image_size)
 
-        self.__records = self.__get_captures(self.__base_dir)
+        # an array rather than a list of Python objects, which is cheap to pickle to workers
+        self.__records = np.array(load_manifest(
+            manifest_path or os.path.join(self.__base_dir, '.manifest.json'),
+            [os.path.join(self.__base_dir, sub) for sub in self.__subdirs],
+            functools.partial(self.__get_captures, self.__base_dir)
+        ), dtype=str).reshape(-1, 4)
         self.__min_depth = 0.2
         self.__max_depth = 100.
         self.__is_training = is_training
         self.__padding = padding
         self.__upsample_factor = upsample_factor
+        self.__n_depths = n_depths
+        self.__layer_labels = layer_labels
+        self.__deferred_upsample = deferred_upsample
+        self.__compact = compact
 
     def __len__(self):
         return len(self.__records)
 
     def __getitem__(self, idx) -> dataset.img_transform.ImageItem:
-        _id = self.__records[idx]
-        image_path = glob.glob(os.path.join(self.__base_dir, 'scaled_images', _id, '*_center.jpg'))[0]
-        depth_path = glob.glob(os.path.join(self.__base_dir, 'merged_depth', _id, '*_center.png'))[0]
-        conf_path = glob.glob(os.path.join(self.__base_dir, 'merged_conf', _id, '*_center.exr'))[0]
+        _id, img, depthmap, conf = self.__read(idx)
+
+        if self.__is_training:
+            img, depthmap, conf = self.__transform(img, depthmap, conf)
+        else:
+            img = self.__centercrop(img)
+            depthmap = self.__centercrop(depthmap)
+            conf = self.__centercrop(conf)
+
+        # Remove batch dim (Kornia adds batch dimension automatically.)
+        img = img.squeeze(0)
+        depthmap = depthmap.squeeze(0)
+        # confidence is thresholded after upsampling if deferred
+        depth_conf = conf.squeeze(0) if self.__deferred_upsample else torch.where(conf.squeeze(0) > 0.99, 1., 0.)
+
+        if self.__layer_labels:
+            labels, _ = utils.depthmap2labels(depthmap, self.__n_depths, binary=True)
+            item = dataset.img_transform.LabeledImageItem(_id, img, depthmap, depth_conf, labels)
+        else:
+            item = dataset.img_transform.ImageItem(_id, img, depthmap, depth_conf)
+        return dataset.img_transform.encode_item(item) if self.__compact else item
+
+    def read_full(self, idx) -> dataset.img_transform.ImageItem:
+        """Read a capture uncropped with its confidence thresholded, e.g. for ``write_tar_shards``."""
+        _id, img, depthmap, conf = self.__read(idx)
+        return dataset.img_transform.ImageItem(_id, img, depthmap, torch.where(conf > 0.99, 1., 0.))
+
+    def __read(self, idx):
+        _id, image_path, depth_path, conf_path = (
+            str(self.__records[idx, 0]),
+            *(os.path.join(self.__base_dir, sub, self.__records[idx, 0], f)
+              for sub, f in zip(self.__subdirs, self.__records[idx, 1:]))
+        )
 
         depthmap = skimage.io.imread(depth_path).astype(np.float32)[..., None] / 255
         img = skimage.io.imread(image_path).astype(np.float32) / 255
@@ -69,20 +129,7 @@ class DualPixel(data.Dataset):
         if depthmap_metric.min() < 1.0:
             depthmap_metric += (1. - depthmap_metric.min())
         depthmap = utils.metric_to_ips(depthmap_metric.clamp(1.0, 5.0), 1.0, 5.0)
-
-        if self.__is_training:
-            img, depthmap, conf = self.__transform(img, depthmap, conf)
-        else:
-            img = self.__centercrop(img)
-            depthmap = self.__centercrop(depthmap)
-            conf = self.__centercrop(conf)
-
-        # Remove batch dim (Kornia adds batch dimension automatically.)
-        img = img.squeeze(0)
-        depthmap = depthmap.squeeze(0)
-        depth_conf = torch.where(conf.squeeze(0) > 0.99, 1., 0.)
-
-        return dataset.img_transform.ImageItem(_id, img, depthmap, depth_conf)
+        return _id, img, depthmap, conf
 
     def __prepare(self, x):
         x = x[CROP_WIDTH:-CROP_WIDTH, CROP_WIDTH:-CROP_WIDTH, :]
@@ -99,11 +146,53 @@ class DualPixel(data.Dataset):
         x = torch.from_numpy(x).permute(2, 0, 1)
         return x
 
-    @staticmethod
-    def __get_captures(base_dir):
-        """Gets a list of captures."""
+    __subdirs = ('scaled_images', 'merged_depth', 'merged_conf')
+    __suffixes = ('_center.jpg', '_center.png', '_center.exr')
+
+    @classmethod
+    def __get_captures(cls, base_dir):
+        """Gets a list of captures, each of which is its id and file names of image, depth and confidence."""
         depth_dir = os.path.join(base_dir, 'merged_depth')
-        return [
-            name for name in os.listdir(depth_dir)
-            if os.path.isdir(os.path.join(depth_dir, name))
-        ]
+        records = []
+        for name in sorted(os.listdir(depth_dir)):
+            if not os.path.isdir(os.path.join(depth_dir, name)):
+                continue
+            files = [
+                next(f for f in sorted(os.listdir(os.path.join(base_dir, sub, name))) if f.endswith(suffix))
+                for sub, suffix in zip(cls.__subdirs, cls.__suffixes)
+            ]
+            records.append([name, *files])
+        return records
+
+
+class UpsamplingCollate:
+    def __init__(self, image_size: Tuple[int, int], n_depths: int = 16):
+        """
+        Collate samples some of which are smaller than image size, e.g. those of ``DualPixel`` with
+        deferred upsampling, upsampling them by batched bicubic interpolation. Confidence of upsampled
+        samples is thresholded, and their layer labels are computed again if there are.
+        :param image_size: Size of collated images
+        :param n_depths: Number of depth layers for layer labels
+        """
+        self.image_size = tuple(image_size)
+        self.n_depths = n_depths
+
+    def __call__(self, samples):
+        small = [i for i, s in enumerate(samples) if tuple(s[1].shape[-2:]) != self.image_size]
+        if small:
+            samples = list(samples)
+            batch = data.dataloader.default_collate([samples[i] for i in small])
+            img, depthmap, conf = (
+                functional.interpolate(x, self.image_size, mode='bicubic', align_corners=False)
+                for x in (batch[1], batch[2], batch[3])
+            )
+            img, depthmap = img.clamp(0, 1), depthmap.clamp(0, 1)
+            conf = torch.where(conf > 0.99, 1., 0.)
+            for j, i in enumerate(small):
+                fields = [samples[i][0], img[j], depthmap[j], conf[j]]
+                if isinstance(samples[i], dataset.img_transform.LabeledImageItem):
+                    labels, _ = utils.depthmap2labels(depthmap[j], self.n_depths, binary=True)
+                    samples[i] = dataset.img_transform.LabeledImageItem(*fields, labels)
+                else:
+                    samples[i] = type(samples[i])(*fields)
+        return data.dataloader.default_collate(samples)
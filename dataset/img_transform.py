@@ -6,6 +6,63 @@ from kornia import augmentation as augmentation
 from torch import nn as nn
 
 ImageItem = collections.namedtuple('ImageItem', ['id', 'image', 'depthmap', 'mask'])
+LabeledImageItem = collections.namedtuple('LabeledImageItem', ImageItem._fields + ('labels',))
+
+# depth maps are quantized to 16 bits but stored with offset in int16, which torch does have
+DEPTH_LEVELS = 65535
+DEPTH_OFFSET = 32768
+
+
+def pack_mask(mask):
+    """
+    Pack a binary mask into bits, eight pixels per byte.
+    :param mask: Mask with any shape
+    :return: 1D uint8 tensor
+    """
+    x = mask.flatten().to(torch.uint8)
+    x = torch.cat([x, x.new_zeros(-len(x) % 8)]).reshape(-1, 8)
+    return (x << torch.arange(7, -1, -1, dtype=torch.uint8, device=x.device)).sum(-1, dtype=torch.uint8)
+
+
+def unpack_mask(packed, shape, dtype=torch.float32):
+    """
+    Unpack masks packed by ``pack_mask``, which may be batched.
+    :param packed: Packed masks with shape ... x N
+    :param shape: Shape of each mask
+    :param dtype: Type of unpacked masks
+    :return: Masks with shape ... x shape
+    """
+    bits = (packed[..., None] >> torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)) & 1
+    n = 1
+    for s in shape:
+        n *= s
+    return bits.flatten(-2)[..., :n].reshape(*packed.shape[:-1], *shape).to(dtype)
+
+
+def encode_item(item):
+    """
+    Encode an item compactly for transport from data workers: image in uint8, depth map quantized
+    to 16 bits and binary mask packed into bits. Items are decoded by ``decode_item`` after transfer.
+    """
+    img, depthmap, mask = item[1], item[2], item[3]
+    if img.dtype != torch.uint8:
+        img = torch.round(img.clamp(0, 1) * 255).to(torch.uint8)
+    depthmap = (torch.round(depthmap.clamp(0, 1) * DEPTH_LEVELS) - DEPTH_OFFSET).to(torch.int16)
+    return type(item)(item[0], img, depthmap, pack_mask(mask > 0.5), *item[4:])
+
+
+def decode_item(item, dtype=torch.float32):
+    """
+    Decode a batch of items encoded by ``encode_item`` into floating point, which is a no-op for
+    items not encoded. Intended to run on device after transfer.
+    """
+    if item[1].dtype != torch.uint8:
+        return item
+    img = item[1].to(dtype) / 255
+    depthmap = (item[2].to(dtype) + DEPTH_OFFSET) / DEPTH_LEVELS
+    mask = unpack_mask(item[3], depthmap.shape[-3:], dtype)
+    fields = [item[0], img, depthmap, mask, *item[4:]]
+    return type(item)(*fields) if hasattr(item, '_fields') else type(item)(fields)
 
 
 class RandomTransform(nn.Module):
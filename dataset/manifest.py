@@ -0,0 +1,34 @@
+import json
+import os
+import typing
+
+
+def load_manifest(path: str, dirs: typing.Sequence[str], scan: typing.Callable[[], typing.Any]):
+    """
+    Load records of a dataset from a manifest file instead of scanning its directories. The manifest
+    is built by scanning if it is missing or stale, i.e. modification time of any of the directories
+    has changed since it was built. Note that mtime of a directory changes only when its entries do,
+    so files modified in place are not detected.
+    :param path: Manifest file, which is not saved if it cannot be written (e.g. read-only mount)
+    :param dirs: Directories scanned for records
+    :param scan: Function scanning directories for records, which have to be JSON-serializable
+    :return: Records
+    """
+    mtimes = {d: os.stat(d).st_mtime_ns for d in dirs}
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['mtimes'] == mtimes:
+            return manifest['records']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    records = scan()
+    tmp = f'{path}.{os.getpid()}.tmp'  # written atomically as several runs may build it at once
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({'mtimes': mtimes, 'records': records}, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return records
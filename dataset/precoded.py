@@ -0,0 +1,157 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import typing
+
+import numpy as np
+import torch
+import torch.multiprocessing
+import torch.utils.data as data
+
+INDEX_FILE = 'index.json'
+
+# camera parameters describing the optical system itself, which are all the digest depends on
+# besides the state dict; training switches and performance options are excluded
+PHYSICAL_PARAMETERS = (
+    'wavelengths', 'image_size', 'crop_width', 'camera_pitch', 'aperture_diameter', 'focal_length',
+    'min_depth', 'max_depth', 'focal_depth', 'n_depths', 'diffraction_efficiency', 'aperture_type',
+    'occlusion', 'bayer', 'noise_sigma', 'shot_noise', 'effective_psf_factor',
+    'degrees', 'grid_size', 'degree', 'full_size', 'aperture_size', 'aperture_upsample_factor'
+)
+
+__base: typing.Any = None
+__model: typing.Any = None
+
+
+def optics_digest(camera, hparams) -> str:
+    """
+    Digest of everything determining coded images, i.e. camera parameters and buffers in its state dict
+    and physical hyperparameters it is constructed from. Options trading speed or precision of simulation
+    are left out so that a store stays valid when they are tuned.
+    :param camera: Camera model
+    :param hparams: Hyperparameters as a dict or namespace
+    :return: Hex digest
+    """
+    if isinstance(hparams, argparse.Namespace):
+        hparams = vars(hparams)
+    params = camera.extract_parameters(hparams)
+    params['crop_width'] = hparams['crop_width']
+    params = {k: v for k, v in params.items() if k in PHYSICAL_PARAMETERS}
+
+    sha = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode())
+    for name, tensor in sorted(camera.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def __init_worker(base, model, n_workers):
+    global __base, __model
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // n_workers))
+    __base, __model = base, model
+
+
+@torch.no_grad()
+def __write_shard(task):
+    root, shard, start, end, batch_size = task
+    torch.manual_seed(shard)  # reproducible noise regardless of scheduling
+
+    path = os.path.join(root, f'shard-{shard:05d}.npy')
+    captures = None
+    ids = []
+    for i in range(start, end, batch_size):
+        batch = data.dataloader.default_collate([__base[j] for j in range(i, min(i + batch_size, end))])
+        coded, _ = __model.image(batch[1], batch[2], getattr(batch, 'labels', None))
+        if captures is None:
+            captures = np.lib.format.open_memmap(path, 'w+', np.float16, (end - start, *coded.shape[1:]))
+        captures[i - start:i - start + len(coded)] = coded.numpy()
+        ids += list(batch[0])
+    captures.flush()
+    return {'file': os.path.basename(path), 'count': end - start}, ids
+
+
+def write_precoded_store(root, base, model, shard_size=256, batch_size=8, n_workers=4):
+    """
+    Simulate coded images of a dataset by a trained model and write them into float16 shards
+    memory-mapped as ``.npy`` files, together with an index stamped with optics digest.
+    Shards are generated in parallel by CPU processes.
+    :param root: Directory of the store
+    :param base: Dataset of scenes, which has to be deterministic (e.g. no random crop)
+    :param model: ``RGBDImagingSystem`` whose camera codes images
+    :param shard_size: Number of images in a shard
+    :param batch_size: Number of images coded at a time
+    :param n_workers: Number of processes
+    :return: Index of the store
+    """
+    os.makedirs(root, exist_ok=True)
+    model = model.cpu().eval()
+    model.camera.clear_psf_memo()
+
+    tasks = [
+        (root, i // shard_size, i, min(i + shard_size, len(base)), batch_size)
+        for i in range(0, len(base), shard_size)
+    ]
+    context = torch.multiprocessing.get_context('spawn')
+    with context.Pool(n_workers, __init_worker, (base, model, n_workers)) as pool:
+        results = pool.map(__write_shard, tasks)
+
+    index = {
+        'digest': optics_digest(model.camera, model.hparams),
+        'dtype': 'float16',
+        'shards': [shard for shard, _ in results],
+        'ids': [id_ for _, ids in results for id_ in ids]
+    }
+    with open(os.path.join(root, INDEX_FILE + '.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(root, INDEX_FILE + '.tmp'), os.path.join(root, INDEX_FILE))
+    return index
+
+
+class PreCodedStore(data.Dataset):
+    def __init__(self, root: str, base: data.Dataset, digest: str = None):
+        """
+        Pair scenes of a dataset with their coded images in a store written by ``write_precoded_store``.
+        Coded images are read zero-copy from memory-mapped shards in float16, and are to be
+        converted after transfer to device.
+        :param root: Directory of the store
+        :param base: The dataset with which the store was written
+        :param digest: Expected optics digest given by ``optics_digest``, not checked if None
+        """
+        super().__init__()
+        with open(os.path.join(root, INDEX_FILE)) as f:
+            index = json.load(f)
+        if digest is not None and index['digest'] != digest:
+            raise ValueError(f'Store in {root} was coded by other optics: {index["digest"]}')
+        if len(index['ids']) != len(base):
+            raise ValueError(f'Store in {root} has {len(index["ids"])} images but dataset has {len(base)}')
+
+        self.digest = index['digest']
+        self.__base = base
+        self.__root = root
+        self.__ids = index['ids']
+        self.__files = [shard['file'] for shard in index['shards']]
+        self.__offsets = np.cumsum([0] + [shard['count'] for shard in index['shards']])
+        self.__captures = None
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def __getitem__(self, item):
+        original = self.__base[item]
+        if original[0] != self.__ids[item]:
+            raise ValueError(f'Scene {original[0]} does not match coded image {self.__ids[item]}')
+        if self.__captures is None:
+            # copy-on-write mapping gives writable arrays without copying
+            self.__captures = [np.load(os.path.join(self.__root, f), mmap_mode='c') for f in self.__files]
+
+        shard = np.searchsorted(self.__offsets, item, side='right') - 1
+        img = torch.from_numpy(self.__captures[shard][item - self.__offsets[shard]])
+        return original[0], original[1], original[2], original[3], img
+
+    def __getstate__(self):
+        # maps are reopened in each worker rather than pickled with their content
+        state = self.__dict__.copy()
+        state['_PreCodedStore__captures'] = None
+        return state
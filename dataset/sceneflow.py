@@ -1,18 +1,21 @@
 import os
+import json
 import typing
+import functools
+import multiprocessing
 
 import torch
 import torch.utils.data as data
 import numpy as np
 import imageio
-import kornia.augmentation as augmentation
 import kornia.filters as filters
 from torchvision import io
 from tqdm import tqdm
 
 import dataset
 import dataset.img_transform
-from utils import srgb_to_linear, crop_boundary
+from dataset.manifest import load_manifest
+from utils import srgb_to_linear, crop_boundary, depthmap2labels
 
 
 def sf_paths(root):
@@ -29,6 +32,147 @@ def sf_paths(root):
     return paths
 
 
+def read_pfm(path: str) -> np.ndarray:
+    """
+    Memory-map a PFM file, so that only the part indexed is read.
+    :return: Top-down view of the raster with shape H x W (or H x W x 3 for color)
+    """
+    with open(path, 'rb') as f:
+        color = f.readline().strip() == b'PF'
+        tokens = []
+        while len(tokens) < 3:
+            tokens += f.readline().split()
+        offset = f.tell()
+    w, h, scale = int(tokens[0]), int(tokens[1]), float(tokens[2])
+    shape = (h, w, 3) if color else (h, w)
+    raster = np.memmap(path, '<f4' if scale < 0 else '>f4', 'r', offset, shape)
+    return raster[::-1]  # rows are stored bottom-up
+
+
+def disparity_range(disparity_path: str) -> typing.Tuple[float, float]:
+    """Minimum and maximum of a disparity map, by which it is normalized."""
+    disparity = read_pfm(disparity_path)
+    return float(disparity.min()), float(disparity.max())
+
+
+def __reflect_index(start, length, size, padding):
+    index = np.arange(start - padding, start - padding + length)
+    if index[0] >= 0 and index[-1] < size:
+        return slice(index[0], index[-1] + 1)
+    index = np.abs(index)
+    return size - 1 - np.abs(size - 1 - index)
+
+
+def read_sample(
+    img_path: str, disparity_path: str, padding: int = 0,
+    window: typing.Tuple[int, int, int, int] = None,
+    value_range: typing.Tuple[float, float] = None
+) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Read an image and its disparity, both reflect-padded, and normalize disparity into depth map.
+    Only the window of disparity is read from its file and only that of image is converted.
+    :param window: Top, left, height and width of the window in padded frame, the whole frame if None
+    :param value_range: Range of disparity given by ``disparity_range``, computed if None
+    :return: Image with shape 3 x h x w and depth map with shape 1 x h x w
+    """
+    img = imageio.imread(img_path)
+    disparity = read_pfm(disparity_path)
+    if value_range is None:
+        value_range = disparity_range(disparity_path)
+
+    h, w = disparity.shape
+    if window is None:
+        window = (0, 0, h + 2 * padding, w + 2 * padding)
+    top, left, crop_h, crop_w = window
+    rows = __reflect_index(top, crop_h, h, padding)
+    cols = __reflect_index(left, crop_w, w, padding)
+
+    img = torch.from_numpy(img[rows][:, cols].astype(np.float32) / 255.).permute(2, 0, 1)
+    disparity = torch.from_numpy(disparity[rows][:, cols].astype(np.float32))[None, ...]
+
+    d_min, d_max = value_range
+    depthmap = 1 - (disparity - d_min) / (d_max - d_min)  # depth of the nearest is 0
+
+    return img, depthmap
+
+
+def build_disparity_ranges(sf_root: str, path: str, splits=('train', 'val')):
+    """Compute disparity range of every sample once and save them by split for ``SceneFlow``."""
+    ranges = {}
+    for split in splits:
+        disparity_dir = sf_paths(sf_root)[split]['disparity']
+        ranges[split] = {
+            os.path.splitext(f)[0]: disparity_range(os.path.join(disparity_dir, f))
+            for f in tqdm(sorted(os.listdir(disparity_dir)), ncols=50, unit='file') if f.endswith('.pfm')
+        }
+    with open(path, 'w') as f:
+        json.dump(ranges, f)
+    return ranges
+
+
+def blur_depthmap(depthmap: torch.Tensor) -> torch.Tensor:
+    # SceneFlow's depthmap has some aliasing artifact. (dfd)
+    return filters.gaussian_blur2d(depthmap, sigma=(0.8, 0.8), kernel_size=(5, 5))
+
+
+def __write_sample_shard(task):
+    sf_root, out_dir, split, shard, ids, padding = task
+    paths = sf_paths(sf_root)[split]
+    images = depthmaps = None
+    for i, id_ in enumerate(ids):
+        img, depthmap = read_sample(
+            os.path.join(paths['img'], f'{id_}.png'), os.path.join(paths['disparity'], f'{id_}.pfm'), padding
+        )
+        depthmap = blur_depthmap(depthmap[None, ...])[0]
+        if images is None:
+            h, w = img.shape[-2:]
+            images = np.lib.format.open_memmap(
+                os.path.join(out_dir, f'image-{shard:05d}.npy'), 'w+', np.uint8, (len(ids), h, w, 3))
+            depthmaps = np.lib.format.open_memmap(
+                os.path.join(out_dir, f'depth-{shard:05d}.npy'), 'w+', np.float32, (len(ids), h, w))
+        images[i] = torch.round(img * 255).permute(1, 2, 0).to(torch.uint8).numpy()
+        depthmaps[i] = depthmap[0].numpy()
+    images.flush()
+    depthmaps.flush()
+    return {'image': f'image-{shard:05d}.npy', 'depth': f'depth-{shard:05d}.npy', 'count': len(ids)}
+
+
+def preprocess_sceneflow(sf_root, out_root, split, padding=0, shard_size=512, n_workers=8):
+    """
+    Decode, pad, normalize and blur SceneFlow samples once, and write them into memory-mapped
+    ``.npy`` shards, images in uint8 (exact for 8-bit source) and depth maps in float32.
+    Shards are written in parallel, and are read by ``SceneFlow`` given ``npy_root``.
+    Note that depth maps are blurred before cropping, which differs from blurring crops only near their borders.
+    :param sf_root: Root directory of SceneFlow
+    :param out_root: Root directory of the store, in which a directory for the split is created
+    :param split: 'train' or 'val'
+    :param padding: Width of reflect padding
+    :param shard_size: Number of samples in a shard
+    :param n_workers: Number of processes
+    :return: Index of the store
+    """
+    paths = sf_paths(sf_root)[split]
+    ids = [
+        os.path.splitext(f)[0] for f in sorted(os.listdir(paths['img']))
+        if f.endswith('.png') and os.path.exists(os.path.join(paths['disparity'], f'{os.path.splitext(f)[0]}.pfm'))
+    ]
+    out_dir = os.path.join(out_root, split)
+    os.makedirs(out_dir, exist_ok=True)
+
+    tasks = [
+        (sf_root, out_dir, split, i // shard_size, ids[i:i + shard_size], padding)
+        for i in range(0, len(ids), shard_size)
+    ]
+    with multiprocessing.get_context('spawn').Pool(n_workers) as pool:
+        shards = list(tqdm(pool.imap(__write_sample_shard, tasks), total=len(tasks), ncols=50, unit='shard'))
+
+    index = {'padding': padding, 'shards': shards, 'ids': ids}
+    with open(os.path.join(out_dir, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(out_dir, 'index.json.tmp'), os.path.join(out_dir, 'index.json'))
+    return index
+
+
 class SceneFlow(data.Dataset):
     def __init__(
         self,
@@ -40,83 +184,166 @@ class SceneFlow(data.Dataset):
         augment: bool = False,
         padding: int = 0,
         n_depths: int = 16,
-        ignore_incomplete: bool = True
+        ignore_incomplete: bool = True,
+        layer_labels: bool = False,
+        npy_root: str = None,
+        raw: bool = False,
+        range_cache: str = None,
+        manifest_path: str = None,
+        compact: bool = False
     ):
+        """
+        :param npy_root: Root directory of samples preprocessed by ``preprocess_sceneflow``,
+            from which samples are read instead of decoded
+        :param raw: Whether to leave samples uncropped and depth maps unblurred, so that they are
+            processed as a batch by ``RGBDImagingSystem`` with ``batch_augment``
+        :param range_cache: File of disparity ranges given by ``build_disparity_ranges``. Disparity of
+            samples with known range is read only within crop window rather than as a whole
+        :param manifest_path: Manifest file listing samples, see ``load_manifest``.
+            Defaults to ``.manifest-{split}.json`` in root directory
+        :param compact: Whether to encode samples by ``encode_item`` for transport
+        """
         super().__init__()
+        if raw and npy_root is not None:
+            raise ValueError('Preprocessed samples are already blurred and cropped by slicing')
         self.__dataset_path = sf_paths(sf_root)
 
         if split not in self.__dataset_path:
             raise ValueError(f'Wrong dataset: {split}; expected: {self.__dataset_path.keys()}')
 
-        self.__transform = dataset.img_transform.RandomTransform(image_size, random_crop, augment)
-        self.__centercrop = augmentation.CenterCrop(image_size)
-
-        self.__records = []
-        pfm_missing_ids = []
-        img_dir = self.__dataset_path[split]['img']
-        disparity_dir = self.__dataset_path[split]['disparity']
-        for filename in sorted(os.listdir(img_dir)):
-            if not filename.endswith('.png'):
-                continue
+        self.__image_size = image_size
+        self.__random_crop = random_crop
+        self.__augment = augment
 
-            id_ = os.path.splitext(filename)[0]
-            disparity_path = os.path.join(disparity_dir, f'{id_}.pfm')
-            if not os.path.exists(disparity_path):
-                pfm_missing_ids.append(id_)
-                continue
-
-            self.__records.append(id_)
-
-        if pfm_missing_ids and not ignore_incomplete:
-            raise ResourceWarning(f'Missing pfm files: {pfm_missing_ids}')
-
-        self.__is_training = torch.tensor(is_training)
+        self.__is_training = is_training
         self.__padding = padding
         self.__n_depths = n_depths
+        self.__layer_labels = layer_labels
+        self.__raw = raw
+        self.__compact = compact
         self.split = split
 
+        self.__store_dir = None
+        self.__store = None
+        if npy_root is not None:
+            self.__store_dir = os.path.join(npy_root, split)
+            with open(os.path.join(self.__store_dir, 'index.json')) as f:
+                index = json.load(f)
+            if index['padding'] != padding:
+                raise ValueError(f'Samples in {npy_root} are padded by {index["padding"]} rather than {padding}')
+            self.__records = np.array(index['ids'])
+            self.__shards = index['shards']
+            self.__offsets = np.cumsum([0] + [shard['count'] for shard in index['shards']])
+            return
+
+        img_dir = self.__dataset_path[split]['img']
+        disparity_dir = self.__dataset_path[split]['disparity']
+        manifest = load_manifest(
+            manifest_path or os.path.join(sf_root, f'.manifest-{split}.json'),
+            (img_dir, disparity_dir), functools.partial(self.__scan, img_dir, disparity_dir)
+        )
+        if manifest['missing'] and not ignore_incomplete:
+            raise ResourceWarning(f'Missing pfm files: {manifest["missing"]}')
+
+        # arrays rather than lists and dicts of Python objects, which are cheap to pickle to workers
+        self.__records = np.array(manifest['ids'])
+        self.__ranges = np.full((len(self.__records), 2), np.nan)
+        if range_cache is not None:
+            with open(range_cache) as f:
+                ranges = json.load(f).get(split, {})
+            for i, id_ in enumerate(manifest['ids']):
+                self.__ranges[i] = ranges.get(id_, np.nan)
+
     def __len__(self):
         return len(self.__records)
 
     def __getitem__(self, item: int) -> dataset.img_transform.ImageItem:
-        id_ = self.__records[item]
-        img_dir = self.__dataset_path[self.split]['img']
-        disparity_dir = self.__dataset_path[self.split]['disparity']
-
-        img, depthmap = self.__prepare(
-            os.path.join(img_dir, f'{id_}.png'),
-            os.path.join(disparity_dir, f'{id_}.pfm')
-        )
+        id_ = str(self.__records[item])
+        if self.__store_dir is not None:
+            img, depthmap = self.__read_store(item)
+        else:
+            img_path, disparity_path, value_range = self.__source(item)
+            if self.__raw:
+                img, depthmap = read_sample(img_path, disparity_path, self.__padding, value_range=value_range)
+            else:
+                h, w = read_pfm(disparity_path).shape[:2]
+                p = self.__padding
+                window = (*self.__crop_window(h + 2 * p, w + 2 * p), *self.__image_size)
+                img, depthmap = read_sample(img_path, disparity_path, p, window, value_range)
+                img, depthmap = self.__flip(img, depthmap)
+                depthmap = blur_depthmap(depthmap[None, ...])[0]
 
-        if self.__is_training:
-            img, depthmap = self.__transform(img, depthmap)
+        if self.__layer_labels:
+            labels, _ = depthmap2labels(depthmap, self.__n_depths, binary=True)
+            item = dataset.LabeledImageItem(id_, img, depthmap, torch.ones_like(depthmap), labels)
         else:
-            img, depthmap = self.__centercrop(img), self.__centercrop(depthmap)
+            item = dataset.ImageItem(id_, img, depthmap, torch.ones_like(depthmap))
+        return dataset.encode_item(item) if self.__compact else item
 
-        # SceneFlow's depthmap has some aliasing artifact. (dfd)
-        depthmap = filters.gaussian_blur2d(depthmap, sigma=(0.8, 0.8), kernel_size=(5, 5))
-        img, depthmap = img.squeeze(0), depthmap.squeeze(0)
+    def read_full(self, item: int) -> dataset.img_transform.ImageItem:
+        """Read a sample uncropped and unflipped, with its depth map blurred as a whole, e.g. for ``write_tar_shards``."""
+        if self.__store_dir is not None:
+            raise ValueError('Samples are read whole only from source files')
+        img_path, disparity_path, value_range = self.__source(item)
+        img, depthmap = read_sample(img_path, disparity_path, self.__padding, value_range=value_range)
+        depthmap = blur_depthmap(depthmap[None, ...])[0]
+        return dataset.ImageItem(str(self.__records[item]), img, depthmap, torch.ones_like(depthmap))
 
-        return dataset.ImageItem(id_, img, depthmap, torch.ones_like(depthmap))
+    def __source(self, item):
+        id_ = str(self.__records[item])
+        img_path = os.path.join(self.__dataset_path[self.split]['img'], f'{id_}.png')
+        disparity_path = os.path.join(self.__dataset_path[self.split]['disparity'], f'{id_}.pfm')
+        if np.isnan(self.__ranges[item, 0]):
+            self.__ranges[item] = disparity_range(disparity_path)
+        return img_path, disparity_path, tuple(self.__ranges[item])
 
-    def __prepare(
-        self, img_path: str, disparity_path: str
-    ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
-        img = imageio.imread(img_path).astype(np.float32) / 255.
-        disparity = np.flip(imageio.imread(
-            disparity_path, format='pfm'
-        ), axis=0).astype(np.float32)
+    def __getstate__(self):
+        # maps are reopened in each worker rather than pickled with their content
+        state = self.__dict__.copy()
+        state['_SceneFlow__store'] = None
+        return state
+
+    @staticmethod
+    def __scan(img_dir, disparity_dir):
+        disparity_files = set(os.listdir(disparity_dir))
+        ids, missing = [], []
+        for filename in sorted(os.listdir(img_dir)):
+            if not filename.endswith('.png'):
+                continue
+
+            id_ = os.path.splitext(filename)[0]
+            (ids if f'{id_}.pfm' in disparity_files else missing).append(id_)
+        return {'ids': ids, 'missing': missing}
 
-        p = self.__padding
-        img = np.pad(img, ((p, p), (p, p), (0, 0)), mode='reflect')
-        disparity = np.pad(disparity, ((p, p), (p, p)), mode='reflect')
+    def __read_store(self, item: int) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        if self.__store is None:
+            # copy-on-write mapping gives writable views without copying
+            self.__store = [(
+                np.load(os.path.join(self.__store_dir, shard['image']), mmap_mode='c'),
+                np.load(os.path.join(self.__store_dir, shard['depth']), mmap_mode='c')
+            ) for shard in self.__shards]
+        shard = np.searchsorted(self.__offsets, item, side='right') - 1
+        images, depthmaps = self.__store[shard]
+        i = item - self.__offsets[shard]
 
-        img = torch.from_numpy(img).permute(2, 0, 1)
-        disparity = torch.from_numpy(disparity)[None, ...]
+        # crop by slicing the maps so that only the window is read and converted
+        h, w = self.__image_size
+        top, left = self.__crop_window(*depthmaps.shape[1:])
+        img = torch.from_numpy(images[i, top:top + h, left:left + w]).permute(2, 0, 1).float() / 255.
+        depthmap = torch.from_numpy(depthmaps[i, None, top:top + h, left:left + w])
+        return self.__flip(img, depthmap)
 
-        disparity -= disparity.min()
-        depthmap = 1 - disparity / disparity.max()  # depth of the nearest is 0
+    def __crop_window(self, full_h, full_w):
+        h, w = self.__image_size
+        if self.__is_training and self.__random_crop:
+            return np.random.randint(full_h - h + 1), np.random.randint(full_w - w + 1)
+        return (full_h - h) // 2, (full_w - w) // 2
 
+    def __flip(self, img, depthmap):
+        if self.__is_training and self.__augment:
+            dims = [d for d, flip in zip((-2, -1), np.random.rand(2) < 0.5) if flip]
+            if dims:
+                img, depthmap = torch.flip(img, dims), torch.flip(depthmap, dims)
         return img, depthmap
 
 
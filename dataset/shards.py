@@ -0,0 +1,218 @@
+import io
+import json
+import multiprocessing
+import os
+import tarfile
+import typing
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data as data
+
+import dataset.img_transform
+from utils import depthmap2labels
+
+SHARD_INDEX_FILE = 'index.json'
+
+
+def __add_array(tar, name, array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    info = tarfile.TarInfo(name)
+    info.size = buffer.tell()
+    buffer.seek(0)
+    tar.addfile(info, buffer)
+
+
+def __write_tar_shard(task):
+    base, out_dir, shard, indices = task
+    torch.set_num_threads(1)
+    path = os.path.join(out_dir, f'shard-{shard:05d}.tar')
+    with tarfile.open(path + '.tmp', 'w') as tar:
+        for i in indices:
+            id_, img, depthmap, mask = base.read_full(i)
+            __add_array(tar, f'{id_}.image.npy', torch.round(img * 255).permute(1, 2, 0).to(torch.uint8).numpy())
+            __add_array(tar, f'{id_}.depth.npy', depthmap[0].numpy().astype(np.float32))
+            if not bool(mask.all()):  # omitted if all valid
+                __add_array(tar, f'{id_}.mask.npy', mask[0].numpy().astype(np.uint8))
+    os.replace(path + '.tmp', path)
+    return {'file': os.path.basename(path), 'count': len(indices)}
+
+
+def write_tar_shards(base, out_dir, indices=None, shard_size=1000, n_workers=8):
+    """
+    Read whole samples of a dataset by its ``read_full`` (``SceneFlow`` or ``DualPixel``) and write them
+    into tar shards, which are read sequentially by ``ShardStream``. Each sample is stored as ``.npy``
+    members named by its id: image in uint8, depth map in float32 and mask in uint8 unless all valid.
+    :param base: Dataset
+    :param out_dir: Directory of shards
+    :param indices: Indices of samples to write, all if None
+    :param shard_size: Number of samples in a shard
+    :param n_workers: Number of processes
+    :return: Index of shards
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    indices = list(range(len(base)) if indices is None else indices)
+    tasks = [
+        (base, out_dir, i // shard_size, indices[i:i + shard_size])
+        for i in range(0, len(indices), shard_size)
+    ]
+    with multiprocessing.get_context('spawn').Pool(n_workers) as pool:
+        shards = pool.map(__write_tar_shard, tasks)
+
+    index = {'shards': shards}
+    with open(os.path.join(out_dir, SHARD_INDEX_FILE + '.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(out_dir, SHARD_INDEX_FILE + '.tmp'), os.path.join(out_dir, SHARD_INDEX_FILE))
+    return index
+
+
+class ShardStream(data.IterableDataset):
+    def __init__(
+        self,
+        roots: typing.Sequence[str],
+        image_size: typing.Tuple[int, int],
+        weights: typing.Sequence[float] = None,
+        random_crop: bool = False,
+        augment: bool = False,
+        n_depths: int = 16,
+        layer_labels: bool = False,
+        buffer_size: int = 32,
+        seed: int = 0,
+        compact: bool = False
+    ):
+        """
+        Stream samples from tar shards written by ``write_tar_shards``, e.g. for training on storage where
+        only sequential reads are fast. Shards of every source are shuffled every epoch and divided
+        disjointly among DataLoader workers of all distributed ranks. Samples read are shuffled by a bounded
+        buffer for each source and drawn from sources at random by their weights, cycling sources exhausted.
+        An epoch has as many samples as all sources in total, like sampling them with ``WeightedRandomSampler``.
+        Rank and world size are captured in the main process (by ``set_epoch`` or ``len``) once the process group
+        is initialized, as DataLoader workers started by spawn do not see it.
+        :param roots: Directories of shards of each source
+        :param image_size: Size of crops
+        :param weights: Probability of drawing from each source, equal if None
+        :param buffer_size: Number of samples in shuffle buffer of each source, which holds whole frames
+        :param seed: Seed shared by all ranks, by which shards are shuffled
+        :param compact: Whether to encode samples by ``encode_item`` for transport
+        """
+        super().__init__()
+        self.__roots = list(roots)
+        self.__shards = []
+        for root in self.__roots:
+            with open(os.path.join(root, SHARD_INDEX_FILE)) as f:
+                self.__shards.append(json.load(f)['shards'])
+        if weights is None:
+            weights = [1.] * len(self.__roots)
+        if len(weights) != len(self.__roots):
+            raise ValueError(f'{len(weights)} weights are given for {len(self.__roots)} sources')
+        self.__weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+
+        self.__image_size = image_size
+        self.__random_crop = random_crop
+        self.__augment = augment
+        self.__n_depths = n_depths
+        self.__layer_labels = layer_labels
+        self.__buffer_size = buffer_size
+        self.__seed = seed
+        self.__compact = compact
+        self.__epoch = 0
+        self.__rank_world = None
+
+    def __len__(self):
+        return sum(shard['count'] for shards in self.__shards for shard in shards) // self.__world()[1]
+
+    def set_epoch(self, epoch: int):
+        """
+        Set epoch by which shards are shuffled, which has to be called on all ranks before each epoch
+        after the process group is initialized, e.g. by ``EpochSetter``.
+        """
+        self.__epoch = epoch
+        self.__world()
+
+    def __iter__(self):
+        rank, world_size = self.__world()
+        info = data.get_worker_info()
+        worker, n_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        consumer, n_consumers = rank * n_workers + worker, world_size * n_workers
+        for root, shards in zip(self.__roots, self.__shards):
+            if len(shards) < n_consumers:
+                raise ValueError(f'{root} has {len(shards)} shards for {n_consumers} workers of all ranks')
+
+        rng = np.random.default_rng([self.__seed, self.__epoch, consumer])
+        streams = [
+            self.__shuffle(self.__cycle(root, shards, consumer, n_consumers), rng)
+            for root, shards in zip(self.__roots, self.__shards)
+        ]
+        # every worker yields as many samples so that ranks stay in step
+        for _ in range(len(self) // n_workers):
+            yield self.__process(next(streams[rng.choice(len(streams), p=self.__weights)]), rng)
+
+    def __cycle(self, root, shards, consumer, n_consumers):
+        cycle = 0
+        while True:
+            # permutation is the same on all ranks, so their shards are disjoint
+            order = np.random.default_rng([self.__seed, self.__epoch, cycle]).permutation(len(shards))
+            for i in order[consumer::n_consumers]:
+                yield from self.__read_shard(os.path.join(root, shards[i]['file']))
+            cycle += 1
+
+    @staticmethod
+    def __read_shard(path):
+        sample = {}
+        with tarfile.open(path, 'r|') as tar:  # read as a stream, i.e. sequentially
+            for member in tar:
+                id_, key, _ = member.name.rsplit('.', 2)
+                if sample and sample['id'] != id_:
+                    yield sample
+                    sample = {}
+                sample['id'] = id_
+                sample[key] = np.load(io.BytesIO(tar.extractfile(member).read()))
+        if sample:
+            yield sample
+
+    def __shuffle(self, stream, rng):
+        buffer = []
+        for sample in stream:
+            if len(buffer) < self.__buffer_size:
+                buffer.append(sample)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+
+    def __process(self, sample, rng):
+        (h, w), (full_h, full_w) = self.__image_size, sample['depth'].shape
+        if self.__random_crop:
+            top, left = rng.integers(full_h - h + 1), rng.integers(full_w - w + 1)
+        else:
+            top, left = (full_h - h) // 2, (full_w - w) // 2
+        window = (slice(top, top + h), slice(left, left + w))
+
+        img = torch.from_numpy(sample['image'][window]).permute(2, 0, 1)
+        if not self.__compact:
+            img = img.float() / 255.
+        depthmap = torch.from_numpy(sample['depth'][window])[None, ...]
+        if 'mask' in sample:
+            mask = torch.from_numpy(sample['mask'][window])[None, ...].float()
+        else:
+            mask = torch.ones_like(depthmap)
+
+        if self.__augment:
+            dims = [d for d, flip in zip((-2, -1), rng.random(2) < 0.5) if flip]
+            if dims:
+                img, depthmap, mask = (torch.flip(x, dims) for x in (img, depthmap, mask))
+
+        if self.__layer_labels:
+            labels, _ = depthmap2labels(depthmap, self.__n_depths, binary=True)
+            item = dataset.img_transform.LabeledImageItem(sample['id'], img, depthmap, mask, labels)
+        else:
+            item = dataset.img_transform.ImageItem(sample['id'], img, depthmap, mask)
+        return dataset.img_transform.encode_item(item) if self.__compact else item
+
+    def __world(self):
+        if dist.is_available() and dist.is_initialized():
+            self.__rank_world = dist.get_rank(), dist.get_world_size()
+        # workers are given the one captured in main process
+        return self.__rank_world or (0, 1)
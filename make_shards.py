@@ -0,0 +1,26 @@
+import argparse
+
+import dataset
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='python %(prog)s {sceneflow,dualpixel} root out_dir [options]')
+    parser.add_argument('dataset', type=str, choices=['sceneflow', 'dualpixel'])
+    parser.add_argument('root', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--skip', type=int, default=0,
+                        help='Number of leading samples to skip, e.g. 3994 held out for validation by train.py')
+    parser.add_argument('--upsample_factor', type=int, default=1)
+    parser.add_argument('--shard_size', type=int, default=1000)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+
+    # image size is unused as samples are read whole
+    if args.dataset == 'sceneflow':
+        base = dataset.SceneFlow(args.root, args.split, (0, 0), is_training=False)
+    else:
+        base = dataset.DualPixel(args.root, args.split, (0, 0), is_training=False, upsample_factor=args.upsample_factor)
+    index = dataset.write_tar_shards(
+        base, args.out_dir, range(args.skip, len(base)), args.shard_size, args.num_workers
+    )
+    print(f'Wrote {len(index["shards"])} shards of {len(base) - args.skip} samples')
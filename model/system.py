@@ -20,7 +20,7 @@ import optics
 
 FinalOutput = collections.namedtuple(
     'FinalOutput',
-    ['capt_img', 'capt_linear', 'est_img', 'est_depthmap', 'target_img', 'target_depthmap', 'psf']
+    ['capt_img', 'capt_linear', 'est_img', 'est_depthmap', 'target_img', 'target_depthmap', 'psf', 'optics']
 )
 
 
@@ -107,13 +107,25 @@ class RGBDImagingSystem(pl.LightningModule):
         optimizer.step()
         optimizer.zero_grad()
 
+    def transfer_batch_to_device(self, batch, device=None):
+        batch = super().transfer_batch_to_device(batch, device)
+        # samples encoded compactly by data workers are decoded on device
+        batch = dataset.decode_item(batch)
+        size = self.hparams.image_sz + 4 * self.crop_width
+        if self.hparams.batch_augment and tuple(batch[1].shape[-2:]) != (size, size):
+            batch = self.__augment_batch(batch, (size, size))
+        return batch
+
     def training_step(self, data: dataset.ImageItem, batch_idx: int):
+        # PSF of previous step, whose graph is freed by its backward, must not be reused
+        # even without optimizer step between them, e.g. when gradients are accumulated
+        self.camera.clear_psf_memo()
         outputs, mask = self.__step_common(data, False)
 
         data_loss, logs = self.__compute_loss(outputs, mask)
         logs = {f'train_loss/{key}': val for key, val in logs.items()}
         if self.hparams.optimize_optics:
-            logs.update(self.camera.specific_log(psf_size=self.hparams.psf_size))
+            logs.update(self.camera.specific_log(psf_size=self.hparams.psf_size, result=outputs.optics))
         self.log_dict(logs)
 
         if not (self.global_step % self.hparams.summary_track_train_every):
@@ -149,12 +161,13 @@ class RGBDImagingSystem(pl.LightningModule):
         )
         self.log('validation/val_loss', val_loss)
 
-    def forward(self, img, depthmap, is_testing, precoded=None):
+    def forward(self, img, depthmap, is_testing, precoded=None, labels=None):
         if precoded is None:
-            captimgs, psf = self.image(img, depthmap)
+            captimgs, psf = self.image(img, depthmap, labels)
+            result = self.camera.optics_result(img.shape[-2:], self.camera.training)
         else:
-            captimgs = precoded
-            psf = None
+            captimgs = precoded.to(img.dtype)
+            psf = result = None
 
         # Apply the Tikhonov-regularized inverse
         # pinv_volumes = inverse.tikhonov_inverse(
@@ -180,15 +193,16 @@ class RGBDImagingSystem(pl.LightningModule):
             utils.linear_to_srgb(captimgs), captimgs,
             est_images, est_depthmaps,
             target_images, target_depthmaps,
-            psf
+            psf, result
         )
 
-    def image(self, img, depthmap):
+    def image(self, img, depthmap, labels=None):
         # invert the gamma correction for sRGB image
         img_linear = utils.srgb_to_linear(img)
 
-        captimgs, _, _ = self.camera(img_linear, depthmap)
-        psf = self.camera.final_psf().unsqueeze(0)
+        captimgs, _, _ = self.camera(img_linear, depthmap, labels=labels)
+        # the same PSF as the camera has just used, which is memoized for this step
+        psf = self.camera.optics_result(img.shape[-2:], self.camera.training).psf.unsqueeze(0)
 
         # Crop the boundary artifact of DFT-based convolution
         captimgs = utils.crop_boundary(captimgs, self.crop_width)
@@ -202,8 +216,9 @@ class RGBDImagingSystem(pl.LightningModule):
         if depth_conf.ndim == 4:
             depth_conf = utils.crop_boundary(depth_conf, self.crop_width * 2)
 
-        precoded = data[4] if len(data) == 5 else None
-        outputs = self(data[1], data[2], False, precoded)
+        labels = data.labels if isinstance(data, dataset.LabeledImageItem) else None
+        precoded = data[4] if len(data) == 5 and labels is None else None
+        outputs = self(data[1], data[2], False, precoded, labels)
 
         est, target = outputs.est_depthmap, outputs.target_depthmap
         if mask:
@@ -212,6 +227,39 @@ class RGBDImagingSystem(pl.LightningModule):
 
         return outputs._replace(est_depthmap=est, target_depthmap=target), depth_conf
 
+    @torch.no_grad()
+    def __augment_batch(self, data, size):
+        """
+        Crop, flip and blur a batch of uncropped samples given by ``SceneFlow`` with ``raw``,
+        the same as done by the dataset for each sample but vectorized over the batch.
+        """
+        x = torch.cat([data[1], data[2], data[3]], dim=1)
+        b, c, full_h, full_w = x.shape
+        h, w = size
+        device = x.device
+        if self.training and self.hparams.randcrop:
+            top = torch.randint(full_h - h + 1, (b, 1, 1, 1), device=device)
+            left = torch.randint(full_w - w + 1, (b, 1, 1, 1), device=device)
+            x = x[
+                torch.arange(b, device=device).reshape(-1, 1, 1, 1),
+                torch.arange(c, device=device).reshape(1, -1, 1, 1),
+                top + torch.arange(h, device=device).reshape(1, 1, -1, 1),
+                left + torch.arange(w, device=device).reshape(1, 1, 1, -1)
+            ]
+        else:
+            top, left = (full_h - h) // 2, (full_w - w) // 2
+            x = x[..., top:top + h, left:left + w]
+        if self.training and self.hparams.augment:
+            flip = torch.rand(2, b, 1, 1, 1, device=device) < 0.5
+            x = torch.where(flip[0], x.flip(-2), x)
+            x = torch.where(flip[1], x.flip(-1), x)
+
+        img, depthmap, mask = x[:, :3], dataset.blur_depthmap(x[:, [3]]), x[:, [4]]
+        if isinstance(data, dataset.LabeledImageItem):
+            labels, _ = utils.depthmap2labels(depthmap, self.hparams.n_depths, binary=True)
+            return dataset.LabeledImageItem(data[0], img, depthmap, mask, labels)
+        return type(data)(data[0], img, depthmap, mask)
+
     def __compute_loss(self, output: FinalOutput, depth_conf):
         depth_loss = self.depth_lossfn(output.est_depthmap * depth_conf, output.target_depthmap * depth_conf)
         image_loss = self.image_lossfn(output.est_img, output.target_img)
@@ -258,13 +306,13 @@ class RGBDImagingSystem(pl.LightningModule):
 
         # log in square root scale rather than linear scale
         if log_psf:
-            psf = self.camera.psf_log([self.hparams.psf_size] * 2, self.hparams.summary_depth_every)
+            psf = self.camera.psf_log([self.hparams.psf_size] * 2, self.hparams.summary_depth_every, output.optics)
             res['optics/psf'] = torch.sqrt(psf[0])
             res['optics/psf_stretched'] = torch.sqrt(psf[1])
             res['optics/heightmap'] = self.camera.heightmap_log([self.hparams.summary_mask_sz] * 2)
 
         if log_mtf:
-            res['optics/mtf'] = torch.sqrt(self.camera.mtf_log(self.hparams.summary_depth_every))
+            res['optics/mtf'] = torch.sqrt(self.camera.mtf_log(self.hparams.summary_depth_every, output.optics))
 
         return res
 
@@ -305,6 +353,10 @@ class RGBDImagingSystem(pl.LightningModule):
 
         # others
         parser.add_argument('--reg_tikhonov', type=float, default=1)
+        utils.add_switch(
+            parser, 'batch_augment', False,
+            'Whether or not to crop, flip and blur uncropped samples as a batch after transfer to device'
+        )
 
         ctype = sys.argv[1]
         etype = sys.argv[2]
@@ -1,6 +1,7 @@
 import abc
 import typing
 import argparse
+import collections
 
 import numpy as np
 import torch
@@ -10,10 +11,11 @@ import debayer
 
 import algorithm.image
 import utils
-from utils import fft as fft, old_complex as old_complex
+from utils import fft as fft
 
 camera_dir = {}
 aperture_types = ('circular', 'square')
+image_formations = ('fft', 'tiled')
 
 
 def register_camera(name, cls):
@@ -32,6 +34,48 @@ def construct_camera(name, params):
     return ct(**ct.extract_parameters(params))
 
 
+def psf2otf(psf, backend='native'):
+    if backend == 'legacy':
+        return fft.fftshift(fft.old_rfft(psf, 2, onesided=False), (-2, -3))
+    return fft.fftshift(fft.fft2(psf), (-2, -1))
+
+
+class OpticsResult:
+    def __init__(self, psf: torch.Tensor, heightmap: typing.Callable[[], torch.Tensor], backend: str = 'native'):
+        r"""
+        Optics of a camera at one optimization step, given by ``DOECamera.optics_result`` and shared by
+        image formation, losses and logs. Heightmap and OTF are computed only when they are accessed.
+        :param psf: Normalized PSF in shape :math:`N_\lambda \times D \times H \times W`
+        :param heightmap: Function giving heightmap of DOE
+        :param backend: Complex backend of the camera, in which OTF is represented
+        """
+        self.psf = psf
+        self.__backend = backend
+        self.__heightmap_fn = heightmap
+        self.__heightmap = None
+        self.__otf = None
+
+    @property
+    def heightmap(self):
+        if self.__stale(self.__heightmap):
+            self.__heightmap = self.__heightmap_fn()
+        return self.__heightmap
+
+    @property
+    def otf(self):
+        if self.__stale(self.__otf):
+            self.__otf = psf2otf(self.psf, self.__backend)
+        return self.__otf
+
+    def __stale(self, x):
+        # computed without graph but now differentiable
+        return x is None or torch.is_grad_enabled() and self.psf.requires_grad and not x.requires_grad
+
+    @property
+    def mtf(self):
+        return fft.abs(self.otf)
+
+
 class DOECamera(nn.Module, metaclass=abc.ABCMeta):
     def __init__(
         self, *,
@@ -49,7 +93,15 @@ class DOECamera(nn.Module, metaclass=abc.ABCMeta):
         occlusion=True,
         bayer=True,
         noise_sigma=(1e-3, 5e-3),
-        design_wavelength=None
+        design_wavelength=None,
+        complex_backend='native',
+        image_formation='fft',
+        tile_size=256,
+        support_tolerance=1e-4,
+        prune_layers=True,
+        layer_chunk=0,
+        fused_sensor=False,
+        shot_noise=0.
     ):
         super().__init__()
         self.__applying_stop = {
@@ -60,6 +112,10 @@ class DOECamera(nn.Module, metaclass=abc.ABCMeta):
             raise ValueError(f'Provided min depth({min_depth}) is too small')
         if aperture_type not in self.__applying_stop:
             raise ValueError(f'Unknown aperture type: {aperture_type}')
+        if image_formation not in image_formations:
+            raise ValueError(f'Unknown image formation: {image_formation}')
+        if complex_backend not in fft.complex_backends:
+            raise ValueError(f'Unknown complex backend: {complex_backend}')
         if design_wavelength is None:
             design_wavelength = wavelengths[len(wavelengths) // 2]
 
@@ -68,17 +124,30 @@ class DOECamera(nn.Module, metaclass=abc.ABCMeta):
         self.aperture_diameter = aperture_diameter
         self.aperture_type = aperture_type
         self.camera_pitch = camera_pitch
+        self.complex_backend = complex_backend
         self.depth_range = (min_depth, max_depth)
         self.design_wavelength = design_wavelength
         self.diffraction_efficiency = diffraction_efficiency
         self.focal_depth = focal_depth
         self.focal_length = focal_length
+        self.fused_sensor = fused_sensor
+        self.image_formation = image_formation
         self.image_size = self.regularize_image_size(image_size)
+        self.layer_chunk = layer_chunk
         self.noise_sigma = noise_sigma
         self.n_depths = n_depths
         self.occlusion = occlusion
+        self.shot_noise = shot_noise
+        self.prune_layers = prune_layers
+        self.support_tolerance = support_tolerance
+        self.tile_size = tile_size
         self.scene_distances: torch.Tensor = ...
         self.wavelengths: torch.Tensor = ...
+        self.demosaic_kernels: torch.Tensor = ...
+        self.__psf_memo = collections.OrderedDict()
+        self.__psf_jitter = None
+        self.__sensor_index = {}
+        self.__sensor_buffer = {}
 
         self.register_buffer(
             'scene_distances',
@@ -86,6 +155,7 @@ class DOECamera(nn.Module, metaclass=abc.ABCMeta):
             persistent=False
         )
         self.register_buffer('wavelengths', torch.tensor(wavelengths), persistent=False)
+        self.register_buffer('demosaic_kernels', utils.demosaic_kernels(), persistent=False)
 
     @abc.abstractmethod
     def psf(self, scene_distances, modulate_phase) -> torch.Tensor:
@@ -112,10 +182,9 @@ Input image size: {self.image_size}\
             delattr(self, name)
         return super().register_buffer(name, tensor, persistent)
 
-    def forward(self, img, depthmap, noise=True):
-        psf = self.final_psf(img.shape[-2:], is_training=self.training).unsqueeze(0)
-        psf = self.normalize(psf)
-        captimg, volume = self.get_capt_img(img, depthmap, psf, self.occlusion)
+    def forward(self, img, depthmap, noise=True, labels=None):
+        psf = self.optics_result(img.shape[-2:], is_training=self.training).psf.unsqueeze(0)
+        captimg, volume = self.get_capt_img(img, depthmap, psf, self.occlusion, labels)
         if noise:
             captimg = self.apply_noise(captimg)
         return captimg, volume, psf
@@ -124,58 +193,162 @@ Input image size: {self.image_size}\
         kwargs = {'dtype': img.dtype, 'device': img.device}
         n_min, n_max = self.noise_sigma
         noise_sigma = (n_max - n_min) * torch.rand((img.shape[0], 1, 1, 1), **kwargs) + n_min
+        if self.fused_sensor:
+            return self.sensor(img, noise_sigma)
 
+        if self.shot_noise > 0:
+            noise_sigma = torch.sqrt(noise_sigma ** 2 + self.shot_noise * img.detach().clamp_min(0))
         if self.debayer is None:
             img = img + noise_sigma * torch.randn(img.shape, **kwargs)
         else:
             captimgs_bayer = utils.to_bayer(img)
+            if self.shot_noise > 0:
+                noise_sigma = utils.to_bayer(noise_sigma)
             captimgs_bayer = captimgs_bayer + noise_sigma * torch.randn(captimgs_bayer.shape, **kwargs)
             img = self.debayer(captimgs_bayer)
         return img
 
-    def get_capt_img(self, img, depthmap, psf, occlusion):
-        with torch.no_grad():
-            layered_mask = utils.depthmap2layers(depthmap, self.n_depths, binary=True)
-            volume = layered_mask * img[:, :, None, ...]
-        return algorithm.image.image_formation(volume, layered_mask, psf, occlusion)
+    def sensor(self, img, noise_sigma):
+        r"""
+        Fused sensor stage equivalent to the unfused one in ``apply_noise``. Mosaic is gathered
+        by cached index pattern instead of masking and noise is added in place. Noise follows
+        Poisson-Gaussian model with variance :math:`\sigma^2+ax` if shot noise coefficient :math:`a`
+        is positive, where signal dependent standard deviation is not differentiated. Intermediate
+        mosaic, noise and stacked channels are written into cached buffers when gradient is disabled.
+        :param img: Image with shape B x 3 x H x W
+        :param noise_sigma: Standard deviation of Gaussian noise with shape B x 1 x 1 x 1
+        :return: Noisy image demosaiced if bayer is used
+        """
+        # out= variants are not differentiable and autograd may save the buffers
+        raw_buffer, noise_buffer, stack_buffer = (None,) * 3
+        if self.debayer is not None and not torch.is_grad_enabled():
+            raw_buffer, noise_buffer, stack_buffer = self.__get_sensor_buffer(img.shape, img.dtype, img.device)
 
-    def final_psf(
-        self,
-        size: typing.Tuple[int, int] = None,
-        is_training: bool = False,
-        use_psf_cache: bool = False
-    ):
-        if use_psf_cache and not is_training and hasattr(self, 'psf_cache'):
-            return utils.pad_or_crop(self.psf_cache, size)
+        if self.debayer is None:
+            raw = img
+        else:
+            mosaic_index, demosaic_index = self.__get_sensor_index(img.shape[-2:], img.device)
+            raw = torch.gather(img, 1, mosaic_index.expand(img.shape[0], -1, -1, -1), out=raw_buffer)
 
-        # PSF jitter
-        device = self.device
-        init_sd = torch.linspace(0, 1, steps=self.n_depths, device=device)
-        if is_training:
-            init_sd += (torch.rand(self.n_depths, device=device) - 0.5) / self.n_depths
-        scene_distances = utils.ips_to_metric(init_sd, self.min_depth, self.max_depth)
-        if is_training:
-            scene_distances[-1] += torch.rand(1, device=device)[0] * (100.0 - self.max_depth)
+        noise = torch.randn_like(raw) if noise_buffer is None else torch.randn(raw.shape, out=noise_buffer)
+        if self.shot_noise > 0:
+            noise.mul_(torch.sqrt(noise_sigma ** 2 + self.shot_noise * raw.detach().clamp_min(0)))
+        else:
+            noise.mul_(noise_sigma)
 
-        dif_psf = self.normalize(self.psf(scene_distances, True))
-        undif_psf = self.undiffracted_psf()
-        psf = self.diffraction_efficiency * dif_psf + (1 - self.diffraction_efficiency) * undif_psf
+        if self.debayer is None:
+            return raw + noise
+        raw.add_(noise)
+        return utils.demosaic(raw, self.demosaic_kernels.to(raw.dtype), demosaic_index, stack_buffer)
 
-        # In training, randomly pixel-shifts the PSF around green channel.
-        if is_training:
-            max_shift = 2
-            r_shift = tuple(np.random.randint(low=-max_shift, high=max_shift, size=2))
-            b_shift = tuple(np.random.randint(low=-max_shift, high=max_shift, size=2))
-            psf_r = torch.roll(psf[0], shifts=r_shift, dims=(-1, -2))
-            psf_g = psf[1]
-            psf_b = torch.roll(psf[2], shifts=b_shift, dims=(-1, -2))
-            psf = torch.stack([psf_r, psf_g, psf_b], dim=0)
+    def get_capt_img(self, img, depthmap, psf, occlusion, labels=None):
+        """
+        Simulate captured image of a scene given by all-in-focus image and depth map.
+        :param labels: Layer labels of depth map given by ``utils.depthmap2labels``, computed from
+            depth map if not given and ``layer_chunk`` is positive
+        :return: Captured image and volume, the latter of which is None for labelled scene
+            in FFT image formation since it is never materialized
+        """
+        if labels is None and self.layer_chunk > 0:
+            labels, _ = utils.depthmap2labels(depthmap, self.n_depths, binary=True)
+        if labels is not None and self.image_formation == 'fft':
+            captimg = algorithm.image.labeled_image_formation(
+                img, labels, psf, occlusion, chunk=self.layer_chunk or self.n_depths
+            )
+            return captimg, None
+
+        with torch.no_grad():
+            if labels is None:
+                layered_mask = utils.depthmap2layers(depthmap, self.n_depths, binary=True)
+            else:
+                index = torch.arange(self.n_depths, device=labels.device)
+                layered_mask = utils.labels2layers(labels, index, dtype=img.dtype)
+            volume = layered_mask * img[:, :, None, ...]
+        full_volume = volume
+        if self.prune_layers:
+            index = algorithm.image.occupied_layers(layered_mask)
+            if len(index) < self.n_depths:
+                volume, layered_mask, psf = (x.index_select(2, index) for x in (volume, layered_mask, psf))
+
+        if self.image_formation == 'tiled':
+            captimg, _ = algorithm.image.tiled_image_formation(
+                volume, layered_mask, psf, occlusion, tile=self.tile_size, tol=self.support_tolerance
+            )
+        else:
+            captimg, _ = algorithm.image.image_formation(volume, layered_mask, psf, occlusion, self.complex_backend)
+        return captimg, fft.fftshift(full_volume)
+
+    def final_psf(self, size: typing.Tuple[int, int] = None, is_training: bool = False):
+        r"""
+        Compute the PSF used for image formation. Results are memoized on the version counters
+        of optics parameters, depth samples, wavelengths and requested size, so repeated calls
+        within one optimization step return the same tensor.
+        :param size: Size of returned PSF, which is padded or cropped to it
+        :param is_training: Whether to jitter depth samples and color channels
+        :return: PSF in shape :math:`N_\lambda \times D \times H \times W`
+        """
+        size = None if size is None else tuple(size)
+        entry = self.__get_psf_entry(is_training)
+        if size not in entry:
+            entry[size] = utils.pad_or_crop(entry[None], size)
+        return entry[size]
 
-        if hasattr(self, 'psf_cache'):
-            self.psf_cache.fill_(psf)
+    def optics_result(self, size: typing.Tuple[int, int] = None, is_training: bool = False) -> OpticsResult:
+        """
+        Compute optics used for image formation, memoized together with ``final_psf``
+        so that everything of one step shares a single PSF.
+        :param size: Size of PSF
+        :param is_training: Whether to jitter depth samples and color channels
+        :return: Optics result with normalized PSF
+        """
+        key = ('optics', None if size is None else tuple(size))
+        entry = self.__get_psf_entry(is_training)
+        if key not in entry:
+            entry[key] = OpticsResult(
+                self.normalize(self.final_psf(size, is_training)), self.heightmap, self.complex_backend
+            )
+        return entry[key]
+
+    def __get_psf_entry(self, is_training):
+        if is_training:
+            if self.__psf_jitter is None:
+                self.__psf_jitter = self.__sample_psf_jitter()
+            scene_distances, shifts = self.__psf_jitter
         else:
-            self.register_buffer('psf_cache', psf, persistent=False)
-        return utils.pad_or_crop(self.psf_cache, size)
+            scene_distances = utils.ips_to_metric(
+                torch.linspace(0, 1, steps=self.n_depths, device=self.device), self.min_depth, self.max_depth
+            )
+            shifts = None
+
+        key = (
+            self.__parameter_versions(),
+            tuple(scene_distances.tolist()),
+            shifts,
+            (self.wavelengths.data_ptr(), self.wavelengths._version),
+            torch.is_grad_enabled()
+        )
+        entry = self.__psf_memo.get(key)
+        if entry is None:
+            entry = {None: self.__compute_final_psf(scene_distances, shifts)}
+            for k in [k for k in self.__psf_memo if k[0] != key[0]]:
+                del self.__psf_memo[k]
+            self.__psf_memo[key] = entry
+            while len(self.__psf_memo) > 4:
+                self.__psf_memo.popitem(last=False)
+        return entry
+
+    def clear_psf_memo(self):
+        """
+        Drop memoized PSFs and the depth jitter of current step. Expected to be called
+        before every training step, as a memoized PSF can be backpropagated through only once.
+        """
+        self.__psf_memo.clear()
+        self.__psf_jitter = None
+
+    def _apply(self, fn):
+        # parameters moved or cast by .to(), .cuda() etc. keep their ids and may keep versions
+        self.clear_psf_memo()
+        return super()._apply(fn)
 
     def apply_stop(self, *args, **kwargs):
         return self.__applying_stop[self.aperture_type](*args, **kwargs)
@@ -209,17 +382,20 @@ Input image size: {self.image_size}\
         return heightmap
 
     @torch.no_grad()
-    def psf_log(self, log_size, depth_step=1):
+    def psf_log(self, log_size, depth_step=1, result: OpticsResult = None):
         # PSF is not visualized at computed size.
-        psf = self.final_psf(log_size, is_training=False, use_psf_cache=True).cpu()
-        psf = self.normalize(psf)
+        if result is None:
+            psf = self.final_psf(log_size, is_training=False)
+        else:
+            psf = utils.pad_or_crop(result.psf, tuple(log_size))
+        psf = self.normalize(psf.cpu())
         psf /= psf.max()
         streched_psf = psf / psf.amax(dim=(0, 2, 3), keepdim=True)
         return self.make_grid(psf, depth_step), self.make_grid(streched_psf, depth_step)
 
     @torch.no_grad()
-    def mtf_log(self, depth_step):
-        mtf = self.mtf
+    def mtf_log(self, depth_step, result: OpticsResult = None):
+        mtf = self.mtf if result is None else result.mtf
         mtf /= mtf.max()
         return self.make_grid(mtf, depth_step)
 
@@ -253,12 +429,11 @@ Input image size: {self.image_size}\
 
     @property
     def otf(self):
-        psf = self.final_psf(use_psf_cache=True)
-        return fft.fftshift(torch.rfft(psf, 2, onesided=False), (-2, -3))
+        return psf2otf(self.final_psf(), self.complex_backend)
 
     @property
     def mtf(self):
-        return old_complex.abs(self.otf)
+        return fft.abs(self.otf)
 
     @property
     def device(self):
@@ -286,6 +461,10 @@ Input image size: {self.image_size}\
             '--noise_sigma_max', type=float, default=5e-3,
             help='Maximum standard deviation of Gaussian noise'
         )
+        parser.add_argument(
+            '--shot_noise', type=float, default=0.,
+            help='Coefficient of signal dependent noise variance, 0 for Gaussian noise only'
+        )
         parser.add_argument('--diffraction_efficiency', type=float, default=0.7, help='Diffraction efficiency')
 
         # type option
@@ -298,6 +477,28 @@ Input image size: {self.image_size}\
             '--initialization_type', type=str, default='default',
             help='How to initialize DOE profile'
         )
+        parser.add_argument(
+            '--complex_backend', type=str, default='native',
+            help='Representation of complex fields in optics and image formation',
+            choices=fft.complex_backends
+        )
+        parser.add_argument(
+            '--image_formation', type=str, default='fft',
+            help='Convolve by full-frame FFT, or by overlap-save tiles with PSF cropped to its support',
+            choices=image_formations
+        )
+        parser.add_argument(
+            '--tile_size', type=int, default=256,
+            help='Size of output tiles for tiled image formation'
+        )
+        parser.add_argument(
+            '--support_tolerance', type=float, default=1e-4,
+            help='Fraction of PSF energy allowed outside cropped support for tiled image formation'
+        )
+        parser.add_argument(
+            '--layer_chunk', type=int, default=0,
+            help='Number of depth layers expanded from labels at a time in image formation, 0 for dense layers'
+        )
 
         # image arguments
         parser.add_argument('--psf_size', type=int, default=64, help='Size of PSF image for log')
@@ -309,6 +510,8 @@ Input image size: {self.image_size}\
         utils.add_switch(parser, 'bayer', True, 'Whether or not to use bayer format')
         utils.add_switch(parser, 'occlusion', True, 'Whether or not to use non-linear image formation model')
         utils.add_switch(parser, 'optimize_optics', True, 'Whether or not to optimize DOE')
+        utils.add_switch(parser, 'prune_layers', True, 'Whether or not to skip empty depth layers in image formation')
+        utils.add_switch(parser, 'fused_sensor', False, 'Whether or not to simulate sensor by the fused stage')
         return parser
 
     @classmethod
@@ -329,7 +532,9 @@ Input image size: {self.image_size}\
         }
         for k in (
             'min_depth', 'max_depth', 'focal_depth', 'n_depths', 'focal_length',
-            'diffraction_efficiency', 'aperture_type', 'occlusion', 'bayer'
+            'diffraction_efficiency', 'aperture_type', 'occlusion', 'bayer', 'complex_backend',
+            'image_formation', 'tile_size', 'support_tolerance', 'prune_layers', 'layer_chunk',
+            'fused_sensor', 'shot_noise'
         ):
             params[k] = kwargs[k]
         return params
@@ -341,6 +546,52 @@ Input image size: {self.image_size}\
             self.register_buffer('undiff_psf', self.normalize(ud), persistent=False)
         return self.undiff_psf
 
+    def __sample_psf_jitter(self):
+        device = self.device
+        init_sd = torch.linspace(0, 1, steps=self.n_depths, device=device)
+        init_sd += (torch.rand(self.n_depths, device=device) - 0.5) / self.n_depths
+        scene_distances = utils.ips_to_metric(init_sd, self.min_depth, self.max_depth)
+        scene_distances[-1] += torch.rand(1, device=device)[0] * (100.0 - self.max_depth)
+
+        # randomly pixel-shifts the PSF around green channel
+        max_shift = 2
+        r_shift = tuple(np.random.randint(low=-max_shift, high=max_shift, size=2).tolist())
+        b_shift = tuple(np.random.randint(low=-max_shift, high=max_shift, size=2).tolist())
+        return scene_distances, (r_shift, b_shift)
+
+    def __compute_final_psf(self, scene_distances, shifts):
+        dif_psf = self.normalize(self.psf(scene_distances, True))
+        undif_psf = self.undiffracted_psf()
+        psf = self.diffraction_efficiency * dif_psf + (1 - self.diffraction_efficiency) * undif_psf
+
+        if shifts is not None:
+            r_shift, b_shift = shifts
+            psf_r = torch.roll(psf[0], shifts=r_shift, dims=(-1, -2))
+            psf_g = psf[1]
+            psf_b = torch.roll(psf[2], shifts=b_shift, dims=(-1, -2))
+            psf = torch.stack([psf_r, psf_g, psf_b], dim=0)
+        return psf
+
+    def __get_sensor_index(self, size, device):
+        key = (*size, device)
+        if key not in self.__sensor_index:
+            self.__sensor_index.clear()
+            self.__sensor_index[key] = (utils.bayer_index(*size, device), utils.demosaic_index(*size, device))
+        return self.__sensor_index[key]
+
+    def __get_sensor_buffer(self, shape, dtype, device):
+        key = (*shape, dtype, device)
+        if key not in self.__sensor_buffer:
+            self.__sensor_buffer.clear()
+            n, _, h, w = shape
+            self.__sensor_buffer[key] = tuple(
+                torch.empty(n, c, h, w, dtype=dtype, device=device) for c in (1, 1, 5)
+            )
+        return self.__sensor_buffer[key]
+
+    def __parameter_versions(self):
+        return tuple((id(p), p._version) for p in self.parameters())
+
     @staticmethod
     def make_grid(image, depth_step):
         # expect image with shape CxDxHxW
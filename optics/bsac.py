@@ -3,7 +3,6 @@ import typing
 import torch
 from torch import Tensor
 import numpy as np
-import scipy.interpolate as intp
 
 import optics
 import utils.fft as fft
@@ -17,8 +16,110 @@ def clamped_knot_vector(n, p):
     return kv
 
 
-def design_matrix(x, k, p) -> np.ndarray:
-    return intp.BSpline.design_matrix(x, k, p).toarray().astype('float32')
+def design_matrix(x, k, p) -> Tensor:
+    return banded_to_dense(*banded_design_matrix(x, k, p), len(k) - p - 1)
+
+
+def banded_design_matrix(x: Tensor, k, p: int) -> typing.Tuple[Tensor, Tensor]:
+    r"""
+    Compute B-spline design matrix in banded form by Cox-de Boor recursion, batched over
+    coordinates of any shape and on their device. Each row of design matrix has
+    at most :math:`p+1` consecutive nonzero entries, only which are stored.
+    :param x: Coordinates in any shape
+    :param k: Knot vector
+    :param p: Degree
+    :return: Nonzero values in shape :math:`\ldots\times(p+1)` and column index of the first one in shape :math:`\ldots`
+    """
+    k = torch.as_tensor(k, dtype=torch.float64, device=x.device)
+    n = len(k) - p - 1
+    x64 = x.double().contiguous()
+
+    # knot span containing x, restricted to nonempty spans in [k_p, k_n]
+    lo = torch.searchsorted(k, k[p:p + 1], right=True).item() - 1
+    hi = torch.searchsorted(k, k[n:n + 1]).item() - 1
+    span = torch.clamp(torch.searchsorted(k, x64.reshape(-1), right=True).reshape(x.shape) - 1, lo, hi)
+
+    left = [x64 - k[span + 1 - j] for j in range(1, p + 1)]
+    right = [k[span + j] - x64 for j in range(1, p + 1)]
+    basis = [torch.ones_like(x64)]
+    for j in range(1, p + 1):
+        saved = torch.zeros_like(x64)
+        for r in range(j):
+            temp = basis[r] / (right[r] + left[j - r - 1])
+            basis[r] = saved + right[r] * temp
+            saved = left[j - r - 1] * temp
+        basis.append(saved)
+    return torch.stack(basis, -1).to(x.dtype), span - p
+
+
+def band_index(start, width) -> Tensor:
+    """Column indices of nonzero values of banded design matrices, in shape of ``start`` x width."""
+    return start.unsqueeze(-1) + torch.arange(width, device=start.device)
+
+
+def banded_to_dense(values, start, n) -> Tensor:
+    """Expand banded design matrices in shape ... x N x (p+1) into dense ones in shape ... x N x n."""
+    index = band_index(start, values.shape[-1])
+    return torch.zeros(*values.shape[:-1], n, dtype=values.dtype, device=values.device).scatter_(-1, index, values)
+
+
+def banded_blocks(values, start, n, block=32) -> typing.Tuple[Tensor, Tensor]:
+    r"""
+    Split rows of banded design matrices into blocks of ``block`` rows, each of which is kept densely
+    on the consecutive columns it touches. Blocks are padded to the widest one, which is narrow
+    as start indices of design matrices on sorted samples are nondecreasing.
+    :param values: Nonzero values in shape :math:`K\times N\times(p+1)`
+    :param start: Column index of the first nonzero value in each row, in shape :math:`K\times N`
+    :param n: Number of columns
+    :param block: Number of rows in a block
+    :return: First column of each block in shape :math:`K\times\lceil N/block\rceil`
+        and blocks in shape :math:`K\times\lceil N/block\rceil\times block\times W`
+    """
+    k = values.shape[-1]
+    pad = -values.shape[-2] % block
+    values = torch.nn.functional.pad(values, [0, 0, 0, pad])
+    start = torch.cat([start, start[..., -1:].expand(*start.shape[:-1], pad)], -1)
+    start = start.reshape(*start.shape[:-1], -1, block)
+
+    lo = start.min(-1).values
+    width = int((start.max(-1).values - lo).max()) + k
+    lo = lo.clamp_max(n - width)
+    blocks = torch.zeros(*start.shape, width, dtype=values.dtype, device=values.device)
+    blocks.scatter_(-1, band_index(start - lo.unsqueeze(-1), k), values.reshape(*start.shape, k))
+    return lo, blocks
+
+
+def block_banded_matmul(lo, blocks, x, n_rows) -> Tensor:
+    r"""
+    Multiply banded matrices :math:`B` given by ``banded_blocks`` by dense matrices :math:`X`. Each block
+    is multiplied by the :math:`W` rows of :math:`X` it touches, so the product is one batched matrix
+    multiplication whose cost is proportional to :math:`W` rather than number of columns of :math:`B`.
+    :param lo: First column of each block
+    :param blocks: Blocks in shape :math:`K\times N_b\times block\times W`
+    :param x: Dense matrices in shape :math:`K\times n\times m`
+    :param n_rows: Number of rows of :math:`B` without padding
+    :return: :math:`BX` in shape :math:`K\times N\times m`
+    """
+    cols = band_index(lo, blocks.shape[-1])  # K x N_b x W
+    rows = x[torch.arange(x.shape[0], device=x.device).reshape(-1, 1, 1), cols]  # K x N_b x W x m
+    return torch.matmul(blocks, rows).reshape(x.shape[0], -1, x.shape[-1])[:, :n_rows]
+
+
+def banded_tensor_product(u_lo, u_blocks, v_lo, v_blocks, c, size) -> Tensor:
+    r"""
+    Evaluate tensor product B-spline surface :math:`h=UcV^T` from blocked banded design matrices,
+    whose cost is proportional to degrees rather than number of control points.
+    It is differentiable with respect to control points.
+    :param u_lo: First column of blocks of design matrix in u direction, given by ``banded_blocks``
+    :param u_blocks: Blocks of design matrix in u direction
+    :param v_lo: First column of blocks of design matrix in v direction
+    :param v_blocks: Blocks of design matrix in v direction
+    :param c: Control points in shape :math:`n\times m`
+    :param size: :math:`(N_u, N_v)`
+    :return: Surface in shape :math:`B\times N_u\times N_v`
+    """
+    h = block_banded_matmul(u_lo, u_blocks, c.expand(u_lo.shape[0], -1, -1), size[0])  # B x N_u x m
+    return block_banded_matmul(v_lo, v_blocks, h.transpose(-1, -2), size[1]).transpose(-1, -2)
 
 
 class BSplineApertureCamera(optics.ClassicCamera):
@@ -29,6 +130,7 @@ class BSplineApertureCamera(optics.ClassicCamera):
         degrees=(3, 3),
         requires_grad: bool = False,
         init_type='default',
+        banded: bool = True,
         **kwargs
     ):
         r"""
@@ -47,6 +149,8 @@ class BSplineApertureCamera(optics.ClassicCamera):
         :param knot_vectors: Knot vectors, default to which used in clamped B-spline
         :param degrees:
         :param requires_grad:
+        :param banded: Whether to evaluate the surface on blocks of banded design matrices,
+            rather than on dense ones
         :param kwargs:
         """
         super().__init__(**kwargs)
@@ -57,8 +161,13 @@ class BSplineApertureCamera(optics.ClassicCamera):
                 clamped_knot_vector(grid_size[0], degrees[0]), clamped_knot_vector(grid_size[1], degrees[1]))
         else:
             self.degrees = (len(knot_vectors[0]) - grid_size[0] - 1, len(knot_vectors[1]) - grid_size[1] - 1,)
+        self.banded = banded
         self.grid_size = grid_size
         self.knot_vectors = knot_vectors
+        self.u_lo: torch.Tensor = ...
+        self.u_blocks: torch.Tensor = ...
+        self.v_lo: torch.Tensor = ...
+        self.v_blocks: torch.Tensor = ...
         self.u_matrix: torch.Tensor = ...
         self.v_matrix: torch.Tensor = ...
 
@@ -69,10 +178,26 @@ class BSplineApertureCamera(optics.ClassicCamera):
         self.control_points = torch.nn.Parameter(init, requires_grad=requires_grad)
 
         # buffered tensors used to compute heightmap in psf
-        self.register_buffer('u_matrix', self.design_matrix(1), persistent=False)
-        self.register_buffer('v_matrix', self.design_matrix(0), persistent=False)
+        u_values, u_start = self.design_matrix(1)
+        v_values, v_start = self.design_matrix(0)
+        self.__size = (u_values.shape[-2], v_values.shape[-2])
+        if banded:
+            u_lo, u_blocks = banded_blocks(u_values, u_start, grid_size[1])
+            v_lo, v_blocks = banded_blocks(v_values, v_start, grid_size[0])
+            self.register_buffer('u_lo', u_lo, persistent=False)
+            self.register_buffer('u_blocks', u_blocks, persistent=False)
+            self.register_buffer('v_lo', v_lo, persistent=False)
+            self.register_buffer('v_blocks', v_blocks, persistent=False)
+        else:
+            self.register_buffer('u_matrix', banded_to_dense(u_values, u_start, grid_size[1]), persistent=False)
+            self.register_buffer('v_matrix', banded_to_dense(v_values, v_start, grid_size[0]), persistent=False)
 
     def heightmap(self):
+        if self.banded:
+            h = banded_tensor_product(
+                self.u_lo, self.u_blocks, self.v_lo, self.v_blocks, self.control_points, self.__size
+            )
+            return utils.fold_profile(h, self.design_wavelength)
         return self.__heightmap(
             self.u_matrix,
             self.v_matrix,
@@ -95,7 +220,7 @@ class BSplineApertureCamera(optics.ClassicCamera):
     def aberration(self, u, v, wavelength: float = None):
         if wavelength is None:
             wavelength = self.wavelengths[len(self.wavelengths) / 2]
-        c = self.control_points.cpu()[None, None, ...]
+        c = self.control_points.to(u.device)[None, None, ...]
 
         r2 = u ** 2 + v ** 2
         scaled_u = self.scale_coordinate(u).squeeze(-2)  # 1 x omega_x x t1
@@ -106,12 +231,8 @@ class BSplineApertureCamera(optics.ClassicCamera):
 
         phase = utils.heightmap2phase(h, wavelength, utils.refractive_index(wavelength))
         phase = torch.transpose(phase, 0, 1)
-        return self.apply_circular_stop(
-            fft.exp2xy(1, phase),
-            r2=torch.stack([r2, r2], -1),
-            x=torch.stack([u, u], -1),
-            y=torch.stack([v, v], -1)
-        )
+        amplitude = self.apply_circular_stop(torch.ones_like(phase), r2=r2, x=u, y=v)
+        return fft.polar(amplitude, phase, self.complex_backend)
 
     @torch.no_grad()
     def heightmap_log(self, size, normalize=True):
@@ -119,7 +240,7 @@ class BSplineApertureCamera(optics.ClassicCamera):
         axis = []
         for sz, kv, p in zip(size, self.knot_vectors, self.degrees):
             axis.append(torch.linspace(0, 1, sz))
-            m.append(torch.from_numpy(design_matrix(axis[-1], kv, p)))
+            m.append(design_matrix(axis[-1], kv, p))
 
         u, v = torch.meshgrid(*axis)
         h = self.__heightmap(*m, self.control_points.cpu())
@@ -140,7 +261,8 @@ class BSplineApertureCamera(optics.ClassicCamera):
         base = super().extract_parameters(kwargs)
         base.update({
             "degrees": [kwargs['bspline_degree']] * 2,
-            "grid_size": [kwargs['bspline_grid_size']] * 2
+            "grid_size": [kwargs['bspline_grid_size']] * 2,
+            "banded": kwargs['bspline_banded']
         })
         return base
 
@@ -155,16 +277,17 @@ class BSplineApertureCamera(optics.ClassicCamera):
             '--bspline_degree', type=int, default=5,
             help='Degree of B-spline surface in each directin'
         )
+        utils.add_switch(
+            base, 'bspline_banded', True,
+            'Whether or not to evaluate B-spline surface on banded design matrices rather than dense ones'
+        )
         return base
 
     @torch.no_grad()
     def design_matrix(self, dim):
-        n, kv, p = self.image_size[dim], self.knot_vectors[dim], self.degrees[dim]
+        kv, p = self.knot_vectors[dim], self.degrees[dim]
         x = torch.flatten(self.u_grid if dim == 1 else self.v_grid, -2, -1)
-
-        x = self.scale_coordinate(x)
-        m = torch.stack([torch.from_numpy(design_matrix(x[i].numpy(), kv, p)) for i in range(x.shape[0])])
-        return m  # n_wl x N x n_ctrl
+        return banded_design_matrix(self.scale_coordinate(x), kv, p)  # n_wl x N x (p+1), n_wl x N
 
     def __heightmap(self, u, v, c) -> Tensor:
         h = torch.matmul(torch.matmul(u, c), torch.transpose(v, -1, -2))
@@ -172,11 +295,4 @@ class BSplineApertureCamera(optics.ClassicCamera):
 
     @staticmethod
     def design_matrices(x, c_n, kv, p):
-        mat = torch.zeros(*x.shape, c_n)
-
-        shape = x.shape
-        mat = mat.reshape(-1, x.shape[-1], c_n)
-        x = x.reshape(-1, x.shape[-1])
-        for i in range(mat.shape[0]):
-            mat[i] = torch.from_numpy(design_matrix(x[i].numpy(), kv, p))
-        return mat.reshape(*shape, c_n)
+        return banded_to_dense(*banded_design_matrix(x, kv, p), c_n)
@@ -6,27 +6,61 @@ import numpy as np
 
 import optics
 import utils
-import utils.old_complex as old_complex
 import utils.fft as fft
 import optics.kernel as kn
 
+psf_modes = ('full', 'fold')
+precisions = ('double', 'single', 'mixed')
+
 
 class ClassicCamera(optics.DOECamera, metaclass=abc.ABCMeta):
-    def __init__(self, effective_psf_factor, double_precision: bool = True, **kwargs):
+    def __init__(
+        self,
+        effective_psf_factor,
+        double_precision: bool = True,
+        psf_mode: str = 'full',
+        psf_window: typing.Union[int, typing.List[int]] = None,
+        precision: str = None,
+        defocus_tolerance: float = 1e-6,
+        **kwargs
+    ):
         r"""
         Construct camera model with a DOE(Diffractive Optical Element) on its aperture.
         The height of DOE :math:`h(u,v)` is given by method heightmap,
         where :math:`(u,v)` is coordinate on the aperture plane.
         Its PSF is computed by DFT(Discrete Fourier Transform), which is 'classic' method.
+        :param psf_mode: 'full' computes the DFT on the whole oversampled pupil grid and keeps
+            every ``scale_factor``-th sample; 'fold' aliases the pupil field into the sampled
+            grid before a DFT which is ``scale_factor`` times smaller in each direction
+        :param psf_window: If given, PSF is evaluated by chirp-Z transform only on a central window
+            of this size and zero elsewhere, which overrides ``psf_mode``
+        :param precision: 'double' computes PSF in float64 throughout and 'single' in float32;
+            'mixed' forms the optical path difference in float64, wraps phase into :math:`[0,2\pi)`
+            and runs the rest in float32. Default to 'double' or 'single' according to ``double_precision``
+        :param defocus_tolerance: Error bound in radian of the series expansion in :math:`1/d`
+            by which defocus phase is evaluated, 0 for exact evaluation
         :param kwargs: Arguments used to construct super class
         """
         super().__init__(**kwargs)
+        if psf_mode not in psf_modes:
+            raise ValueError(f'Unknown PSF mode: {psf_mode}')
+        if not precision:
+            precision = 'double' if double_precision else 'single'
+        if precision not in precisions:
+            raise ValueError(f'Unknown precision: {precision}')
 
-        self.double_precision = double_precision
+        self.precision = precision
+        self.psf_mode = psf_mode
+        self.psf_window = None if not psf_window else self.regularize_image_size(psf_window)
         self.psf_sample_factor = effective_psf_factor
         self.u_grid: torch.Tensor = ...
         self.v_grid: torch.Tensor = ...
         self.r2: torch.Tensor = ...
+        self.stop_mask: torch.Tensor = ...
+        self.stop_r2_min: torch.Tensor = ...
+        self.focal_phase: torch.Tensor = ...
+        self.r2_powers: torch.Tensor = ...
+        self.fold_phase: torch.Tensor = ...
 
         self.scale_factor = int(torch.ceil(
             self.camera_pitch * self.aperture_diameter / (torch.min(self.wavelengths) * self.sensor_distance)
@@ -34,6 +68,9 @@ class ClassicCamera(optics.DOECamera, metaclass=abc.ABCMeta):
         self.register_buffer('u_grid', self.uv_grid(1)[:, None, :], persistent=False)
         self.register_buffer('v_grid', self.uv_grid(0)[:, :, None], persistent=False)
         self.register_buffer('r2', self.u_grid ** 2 + self.v_grid ** 2, persistent=False)
+        if psf_mode == 'fold':
+            self.register_buffer('fold_phase', self.fold_ramp(), persistent=False)
+        self.defocus_order = self.prepare_pupil_buffers(defocus_tolerance)
 
     @abc.abstractmethod
     def lattice_focal_init(self):
@@ -51,42 +88,120 @@ class ClassicCamera(optics.DOECamera, metaclass=abc.ABCMeta):
 
     def psf(self, scene_distances, modulate_phase):
         with torch.no_grad():
-            r2 = self.r2.unsqueeze(1)  # n_wl x D x N_u x N_v
             scene_distances = scene_distances.reshape(1, -1, 1, 1)
             wl = self.wavelengths.reshape(-1, 1, 1, 1)
-            if self.double_precision:
-                r2, scene_distances, wl = r2.double(), scene_distances.double(), wl.double()
+            if self.precision != 'single':
+                scene_distances, wl = scene_distances.double(), wl.double()
+            r2 = self.r2.unsqueeze(1).to(scene_distances.dtype)  # n_wl x D x N_u x N_v
 
             item = r2 + scene_distances ** 2
-            phase1 = torch.sqrt(item) - scene_distances
-            phase2 = torch.sqrt(r2 + self.focal_depth ** 2) - self.focal_depth
-            phase = (phase1 - phase2) * (2 * np.pi / wl)
-            amplitude = scene_distances / (wl * item)
-            amplitude = self.apply_stop(
-                amplitude,
-                x=self.u_grid.unsqueeze(1), y=self.v_grid.unsqueeze(1),
-                r2=r2
-            )
-            amplitude = amplitude / amplitude.max()
+            if self.defocus_order and scene_distances.min() >= self.depth_range[0] / 2:
+                defocus = torch.einsum('dk,kwuv->wduv', self.defocus_coefficients(scene_distances), self.r2_powers)
+            else:
+                defocus = torch.sqrt(item) - scene_distances
+            phase = (defocus - self.focal_phase.unsqueeze(1)) * (2 * np.pi / wl)
+
+            # amplitude peaks at the innermost open sample
+            peak = scene_distances / (wl * (self.stop_r2_min + scene_distances ** 2))
+            amplitude = self.stop_mask.unsqueeze(1) * scene_distances / (wl * item) / peak.max()
+            if self.precision == 'mixed':
+                phase = torch.remainder(phase, 2 * np.pi).float()
+                amplitude, wl = amplitude.float(), wl.float()
 
         if modulate_phase:
             phase += utils.heightmap2phase(self.heightmap().unsqueeze(1), wl, utils.refractive_index(wl))
 
-        psf = old_complex.abs2(fft.old_fft_exp(amplitude, phase))
         sf = self.scale_factor
-        psf = psf[..., sf // 2::sf, sf // 2::sf]
+        if self.psf_window is not None:
+            psf = self.chirp_z_psf(amplitude, phase, self.psf_window)
+        elif self.psf_mode == 'fold':
+            field = fft.polar(amplitude, phase + self.fold_phase, self.complex_backend)
+            field = fft.fold(field, sf, (-2, -1) if field.is_complex() else (-3, -2))
+            psf = fft.abs2(fft.fft2(field, self.complex_backend))
+        else:
+            psf = fft.abs2(fft.fft2(fft.polar(amplitude, phase, self.complex_backend), self.complex_backend))
+            psf = psf[..., sf // 2::sf, sf // 2::sf]
         psf *= torch.prod(self.interval, 1).reshape(-1, 1, 1, 1) ** 2
         psf /= (wl * self.sensor_distance) ** 2
-        if self.double_precision:
+        if self.precision == 'double':
             psf = psf.float()
-        psf = fft.fftshift(psf, (-1, -2))
+        if self.psf_window is None:
+            psf = fft.fftshift(psf, (-1, -2))
 
         return utils.pad_or_crop(psf, self.image_size)
 
-    def specific_log(self, *args, **kwargs):
-        log = super().specific_log(*args, **kwargs)
-        h = self.heightmap()
-        h = self.apply_stop(h, r2=self.r2, x=self.u_grid, y=self.v_grid)
+    @torch.no_grad()
+    def prepare_pupil_buffers(self, tolerance):
+        r"""
+        Register depth independent parts of pupil field as buffers: aperture stop mask,
+        minimum of :math:`r^2` in the stop, focal phase :math:`\sqrt{r^2+d_f^2}-d_f` and powers of
+        :math:`r^2` used by the expansion :math:`\sqrt{r^2+d^2}-d=\sum_{k\geq1}\binom{1/2}{k}r^{2k}d^{1-2k}`.
+        The expansion is truncated at the lowest order whose next term is below ``tolerance`` (in radian)
+        for all depths beyond half of minimum depth, which leaves a margin for depth jitter.
+        :param tolerance: Error bound of defocus phase, 0 for exact evaluation
+        :return: Order of expansion, 0 if it is not used
+        """
+        dtype = torch.float32 if self.precision == 'single' else torch.float64
+        mask = self.apply_stop(torch.ones_like(self.r2), x=self.u_grid, y=self.v_grid, r2=self.r2)
+        r2 = self.r2.to(dtype) * mask
+        self.register_buffer('stop_mask', mask.to(dtype), persistent=False)
+        self.register_buffer(
+            'stop_r2_min',
+            torch.where(mask > 0, r2, torch.full_like(r2, np.inf)).flatten(1).min(1)[0].reshape(-1, 1, 1, 1),
+            persistent=False
+        )
+        self.register_buffer('focal_phase', torch.sqrt(r2 + self.focal_depth ** 2) - self.focal_depth, persistent=False)
+
+        order = 0
+        d = self.depth_range[0] / 2
+        x = r2.max().item() / d ** 2
+        if tolerance > 0 and x < 1:
+            term = d * 2 * np.pi / torch.min(self.wavelengths).item()
+            for k in range(1, 9):
+                term *= abs(0.5 - k + 1) / k * x
+                if term < tolerance:
+                    order = max(k - 1, 1)
+                    break
+        if order:
+            self.register_buffer('r2_powers', torch.stack([r2 ** k for k in range(1, order + 1)]), persistent=False)
+        return order
+
+    def defocus_coefficients(self, scene_distances):
+        r"""
+        Coefficients of the expansion of defocus phase for given depths.
+        :param scene_distances: Depths in any shape
+        :return: Coefficients in shape :math:`D \times K`
+        """
+        d = scene_distances.reshape(-1, 1)
+        k = torch.arange(1, self.defocus_order + 1, dtype=d.dtype, device=d.device)
+        binomial = torch.cumprod((1.5 - k) / k, 0)
+        return binomial * d ** (1 - 2 * k)
+
+    def chirp_z_psf(self, amplitude, phase, window, pitch=None):
+        """
+        Evaluate squared magnitude of the DFT of pupil field only on a window of sensor plane
+        centered at the optical axis, using chirp-Z transform along each direction.
+        :param amplitude: Amplitude of pupil field
+        :param phase: Phase of pupil field
+        :param window: Size of window in pixels
+        :param pitch: Sampling interval on sensor plane, default to camera pitch
+        :return: Unscaled PSF on the window, centered at pixel ``window // 2``
+        """
+        if pitch is None:
+            pitch = self.camera_pitch
+        sf = self.scale_factor
+        field = fft.exp2complex(amplitude, phase)
+        for dim in (0, 1):
+            n = self.image_size[dim] * sf // self.psf_sample_factor
+            step = sf * pitch / self.camera_pitch
+            start = sf // 2 - step * (window[dim] // 2)
+            field = fft.zoom_dft(field, start / n, step / n, window[dim], dim - 2)
+        return fft.abs2(field)
+
+    def specific_log(self, *args, result: optics.OpticsResult = None, **kwargs):
+        log = super().specific_log(*args, result=result, **kwargs)
+        h = self.heightmap() if result is None else result.heightmap
+        h = torch.where(self.stop_mask > 0, h.detach(), torch.zeros((), dtype=h.dtype, device=h.device))
         log['optics/heightmap_max'] = h.max()
         log['optics/heightmap_min'] = h.min()
         return log
@@ -112,7 +227,11 @@ class ClassicCamera(optics.DOECamera, metaclass=abc.ABCMeta):
         base = super().extract_parameters(kwargs)
         base.update({
             'double_precision': kwargs['double_precision'],
-            'effective_psf_factor': kwargs['effective_psf_factor']
+            'effective_psf_factor': kwargs['effective_psf_factor'],
+            'psf_mode': kwargs['psf_mode'],
+            'psf_window': kwargs['psf_window'],
+            'precision': kwargs['precision'],
+            'defocus_tolerance': kwargs['defocus_tolerance']
         })
         return base
 
@@ -121,6 +240,22 @@ class ClassicCamera(optics.DOECamera, metaclass=abc.ABCMeta):
         base = super().add_specific_args(parser)
         base.add_argument('--effective_psf_factor', type=int, default=1, help='')
         utils.add_switch(base, 'double_precision', True, 'Whether or not to compute PSF in double precision')
+        base.add_argument(
+            '--precision', type=str, default=None, choices=precisions,
+            help='Floating point precision of PSF computation, which overrides double_precision if given'
+        )
+        base.add_argument(
+            '--defocus_tolerance', type=float, default=1e-6,
+            help='Error bound in radian of series expansion of defocus phase, 0 for exact evaluation'
+        )
+        base.add_argument(
+            '--psf_mode', type=str, default='full', choices=psf_modes,
+            help='How to sample PSF from the oversampled pupil field'
+        )
+        base.add_argument(
+            '--psf_window', type=int, default=0,
+            help='Size of central window on which PSF is evaluated by chirp-Z transform, 0 for full field'
+        )
         return base
 
     @torch.no_grad()
@@ -128,3 +263,19 @@ class ClassicCamera(optics.DOECamera, metaclass=abc.ABCMeta):
         n = self.image_size[dim] * self.scale_factor // self.psf_sample_factor
         x = torch.linspace(-n / 2, n / 2, n).reshape((1, -1)) * self.interval[:, [dim]]  # n_wl x N
         return x
+
+    @torch.no_grad()
+    def fold_ramp(self):
+        r"""
+        Linear phase :math:`-2\pi c(n_v/N_v+n_u/N_u)` with :math:`c` being the first DFT bin kept
+        in 'full' mode, so that aliasing the modulated field picks the same samples.
+        :return: Phase ramp in shape :math:`N_v \times N_u`
+        """
+        sf = self.scale_factor
+        ramps = []
+        for dim in (0, 1):
+            n = self.image_size[dim] * sf // self.psf_sample_factor
+            if n % sf != 0:
+                raise ValueError(f'Pupil grid size ({n}) must be a multiple of scale factor ({sf}) in fold mode')
+            ramps.append(-2 * np.pi * (sf // 2) * torch.arange(n) / n)
+        return ramps[0][:, None] + ramps[1][None, :]
@@ -4,7 +4,6 @@ import numpy as np
 import torch
 
 import utils.fft as fft
-import utils.old_complex as old_complex
 
 
 def get_delta(delta0, f, d):
@@ -57,9 +56,9 @@ def kernel_spectrum(
     v = torch.flip(v, (0,))
 
     phi1, phi2 = phi(t1 + u / 2, t2 + v / 2), phi(t1 - u / 2, t2 - v / 2)
-    xi = old_complex.multiply(phi1, old_complex.conj(phi2))
+    xi = fft.multiply(phi1, fft.conj(phi2))
 
-    res = fft.fftshift(old_complex.abs2(torch.ifft(xi, 2)))
+    res = fft.fftshift(fft.abs2(fft.ifft2(xi)))
     if c1 != 0 and c2 != 0:
         res = res[..., c1:-c1, c2:-c2]
     res = torch.sqrt(res)
@@ -67,6 +66,6 @@ def kernel_spectrum(
         res /= torch.max(res)
 
     if show_xi:
-        return res, old_complex.abs(xi),
+        return res, fft.abs(xi),
     else:
         return res
@@ -1,3 +1,4 @@
+import functools
 import typing
 from typing import Union, Dict
 import math
@@ -25,6 +26,21 @@ def _find_index(a, v):
     return torch.from_numpy(index)
 
 
+def _bessel_integral(rho_grid, r):
+    r"""
+    Integral :math:`\int_0^r tJ_0(2\pi\rho t)dt=rJ_1(2\pi\rho r)/(2\pi\rho)` in double precision.
+    :math:`J_1` is evaluated by torch on the device of ``rho_grid`` if available, otherwise by scipy on CPU.
+    """
+    device = rho_grid.device
+    rho_grid, r = rho_grid.double(), r.double()
+    x = 2 * math.pi * rho_grid * r
+    if hasattr(torch, 'special') and hasattr(torch.special, 'bessel_j1'):
+        j1 = torch.special.bessel_j1(x)
+    else:
+        j1 = torch.from_numpy(scipy.special.jv(1, x.cpu().numpy())).to(device)
+    return torch.where(rho_grid == 0, 1 / 2 * r ** 2, 1 / (2 * math.pi * rho_grid) * r * j1)
+
+
 def _copy_quadruple(x_rd):
     x_ld = torch.flip(x_rd, dims=(-2,))
     x_d = torch.cat([x_ld, x_rd], dim=-2)
@@ -41,8 +57,14 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
         aperture_upsample_factor=1,
         requires_grad: bool = False,
         init_type='default',
+        hankel_chunk: int = 0,
         **kwargs
     ):
+        """
+        :param hankel_chunk: If positive, Hankel kernel is not stored but generated on the fly
+            in blocks of this many radial samples when computing PSF, and regenerated in backward pass,
+            so that memory does not scale with aperture size times number of PSF samples
+        """
         super().__init__(**kwargs)
         if self.aperture_type != 'circular':
             raise ValueError(f'Rotationally symmetric camera supports circular aperture only')
@@ -53,22 +75,20 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
         self.__aperture_upsample_factor = aperture_upsample_factor
         self.__full_size = self.regularize_image_size(full_size)
         self.__aperture_size = aperture_size
+        self.__hankel_chunk = hankel_chunk
 
-        self.__rho_sampling_full = None
-        self.__ind_full = None
+        self.__h_full = None
+        self.__rho_grid_full = None
 
         self.__build_camera()
 
     def psf(self, scene_distances, modulate_phase):
         # As this quadruple will be copied to the other three, rho = 0 is avoided.
-        psf1d = self.__psf1d(self.buf_h, scene_distances, modulate_phase)
-        psf_rd = functional.relu(cubic.interp(
-            self.buf_rho_grid, psf1d, self.buf_rho_sampling, self.buf_ind
+        h = None if self.__hankel_chunk > 0 else self.buf_h
+        psf1d = self.__psf1d(h, scene_distances, modulate_phase)
+        psf_rd = functional.relu(cubic.interp_with_matrix(
+            self.buf_interp, psf1d, (self.image_size[0] // 2, self.image_size[1] // 2)
         ).float())
-        psf_rd = psf_rd.reshape(
-            self.n_wavelengths, self.n_depths,
-            self.image_size[0] // 2, self.image_size[1] // 2
-        )
         return _copy_quadruple(psf_rd)
 
     def heightmap(self):
@@ -97,7 +117,7 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
         h = profile[index]
 
         phase = utils.heightmap2phase(h, wavelength, utils.refractive_index(wavelength))
-        return self.apply_stop(fft.exp2xy(1, phase), r2=torch.stack([r2, r2], -1))
+        return fft.polar(self.apply_stop(torch.ones_like(phase), r2=r2), phase, self.complex_backend)
 
     def specific_log(self, *args, **kwargs):
         log = super().specific_log(*args, **kwargs)
@@ -105,6 +125,16 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
         log['optics/heightmap_min'] = self.heightmap1d.min()
         return log
 
+    @property
+    def buf_h_full(self):
+        self.__build_full_kernel()
+        return self.__h_full
+
+    @property
+    def buf_rho_grid_full(self):
+        self.__build_full_kernel()
+        return self.__rho_grid_full
+
     @property
     def aperture_pitch(self):
         return self.aperture_diameter / self.__aperture_size
@@ -122,16 +152,17 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
         return self.height_profile
 
     @classmethod
-    def extract_parameters(cls, **kwargs) -> typing.Dict:
+    def extract_parameters(cls, kwargs) -> typing.Dict:
         init_type = kwargs['initialization_type']
         if init_type != 'default':
             raise ValueError(f'Unsupported initialization type: {kwargs["initialization_type"]}')
 
-        base = super().extract_parameters(**kwargs)
+        base = super().extract_parameters(kwargs)
         base.update({
             'full_size': kwargs['full_size'],
             'aperture_upsample_factor': kwargs['mask_upsample_factor'],
             'aperture_size': kwargs['mask_sz'],
+            'hankel_chunk': kwargs['hankel_chunk'],
         })
         return base
 
@@ -146,14 +177,20 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
             '--full_size', type=int, default=1920,
             help=''
         )
+        base.add_argument(
+            '--mask_upsample_factor', type=int, default=1,
+            help='Upsampling factor from trained height profile to axial samples'
+        )
+        base.add_argument(
+            '--hankel_chunk', type=int, default=0,
+            help='Number of radial samples per block of Hankel kernel generated on the fly, 0 for precomputed kernel'
+        )
+        return base
 
     def __build_camera(self):
-        h, rho_grid, rho_sampling = self.__precompute_h(self.image_size)
+        h, rho_grid, rho_sampling = self.__precompute_h(self.image_size, self.__hankel_chunk <= 0)
         ind = _find_index(rho_grid, rho_sampling)
 
-        h_full, rho_grid_full, rho_sampling_full = self.__precompute_h(self.__full_size)
-        ind_full = _find_index(rho_grid_full, rho_sampling_full)
-
         if not (rho_grid.max(dim=-1)[0] >= rho_sampling.reshape(self.n_wavelengths, -1).max(dim=-1)[0]).all():
             raise RuntimeError('Grid (max): {}, Sampling (max): {}'.format(
                 rho_grid.max(dim=-1)[0],
@@ -165,20 +202,28 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
                 rho_sampling.reshape(self.n_wavelengths, -1).min(dim=-1)[0]
             ))
 
-        self.register_buffer('buf_h', h, persistent=False)
+        if h is not None:
+            self.register_buffer('buf_h', h, persistent=False)
         self.register_buffer('buf_rho_grid', rho_grid, persistent=False)
         self.register_buffer('buf_rho_sampling', rho_sampling, persistent=False)
         self.register_buffer('buf_ind', ind, persistent=False)
-        self.register_buffer('buf_h_full', h_full, persistent=False)
-        self.register_buffer('buf_rho_grid_full', rho_grid_full, persistent=False)
-        # These two parameters are not used for training.
-        self.__rho_sampling_full = rho_sampling_full
-        self.__ind_full = ind_full
-
-    def __precompute_h(self, img_size):
+        # interpolation from 1D PSF to a quadrant, sampling positions being fixed
+        self.register_buffer('buf_interp', cubic.interp_matrix(rho_grid, rho_sampling, ind), persistent=False)
+
+    @torch.no_grad()
+    def __build_full_kernel(self):
+        # Not used for training, so it is built on first use only.
+        if self.__h_full is not None:
+            return
+        h_full, rho_grid_full, _ = self.__precompute_h(self.__full_size)
+        self.__h_full = h_full.to(self.device)
+        self.__rho_grid_full = rho_grid_full.to(self.device)
+
+    def __precompute_h(self, img_size, kernel=True):
         """
         This is assuming that the defocus phase doesn't change much in one pixel.
         Therefore, the mask_size has to be sufficiently large.
+        The kernel is omitted (None) if not required.
         """
         # As this quadruple will be copied to the other three, zero is avoided.
         coord_y = self.camera_pitch * torch.arange(1, img_size[0] // 2 + 1).reshape(-1, 1)
@@ -192,27 +237,35 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
         )
 
         # n_wl x 1 x n_rho_grid
-        factor = 1 / (self.wavelengths.reshape(-1, 1, 1) * self.sensor_distance)
+        factor = 1 / (self.wavelengths.cpu().reshape(-1, 1, 1) * self.sensor_distance)
         rho_grid = rho_grid.reshape(1, 1, -1) * factor
         # n_wl X (image_size[0]//2 + 1) X (image_size[1]//2 + 1)
         rho_sampling = rho_sampling.unsqueeze(0) * factor
 
-        r = self.aperture_pitch * torch.linspace(1, self.__aperture_size / 2, self.__aperture_size // 2).double()
-        r = r.reshape(1, -1, 1)
-        j = torch.where(
-            rho_grid == 0,
-            1 / 2 * r ** 2,
-            1 / (2 * math.pi * rho_grid) * r * scipy.special.jv(1, 2 * math.pi * rho_grid * r)
+        h = self.__hankel_kernel(rho_grid.squeeze(1), 0, self.__aperture_size // 2) if kernel else None
+        return h, rho_grid.squeeze(1), rho_sampling
+
+    def __hankel_kernel(self, rho_grid, start, end):
+        """Rows [start, end) of Hankel kernel in shape n_wl x (end - start) x n_rho."""
+        r = self.aperture_pitch * torch.linspace(
+            1, self.__aperture_size / 2, self.__aperture_size // 2, dtype=torch.double, device=rho_grid.device
         )
+        j = _bessel_integral(rho_grid.unsqueeze(1), r[max(start - 1, 0):end].reshape(1, -1, 1))
         h = j[:, 1:, :] - j[:, :-1, :]
-        h0 = j[:, 0:1, :]
-        return torch.cat([h0, h], dim=1), rho_grid.squeeze(1), rho_sampling
+        if start == 0:
+            h = torch.cat([j[:, 0:1, :], h], dim=1)
+        return h
+
+    def __hankel_product(self, start, end, real, imag):
+        h = self.__hankel_kernel(self.buf_rho_grid, start, end).unsqueeze(1)  # n_wl x 1 x n_r x n_rho
+        return torch.matmul(real, h), torch.matmul(imag, h)
 
     def __psf1d(self, h, scene_distances, modulate_phase=torch.tensor(True)):
         """Perform all computations in double for better precision. Float computation fails."""
         prop_amplitude, prop_phase = self.__pointsource_inputfield1d(scene_distances)
 
-        h = h.unsqueeze(1)  # n_wl x 1 x n_r x n_rho
+        if h is not None:
+            h = h.unsqueeze(1)  # n_wl x 1 x n_r x n_rho
         wavelengths = self.wavelengths.reshape(-1, 1, 1).double()
         phase = prop_phase
         if modulate_phase:
@@ -225,11 +278,30 @@ class RotationallySymmetricCamera(optics.base.DOECamera):
         # broadcast the matrix-vector multiplication
         phase = phase.unsqueeze(2)  # n_wl X D X 1 x n_r
         amplitude = prop_amplitude.unsqueeze(2)  # n_wl X D X 1 x n_r
-        real = torch.matmul(amplitude * torch.cos(phase), h).squeeze(-2)
-        imag = torch.matmul(amplitude * torch.sin(phase), h).squeeze(-2)
+        if h is not None:
+            real = torch.matmul(amplitude * torch.cos(phase), h).squeeze(-2)
+            imag = torch.matmul(amplitude * torch.sin(phase), h).squeeze(-2)
+        else:
+            real, imag = self.__streamed_hankel(amplitude * torch.cos(phase), amplitude * torch.sin(phase))
 
         return (2 * math.pi / wavelengths / self.sensor_distance) ** 2 * (real ** 2 + imag ** 2)
 
+    def __streamed_hankel(self, real, imag):
+        """Multiply pupil field by Hankel kernel blocks generated on the fly, recomputing them in backward pass."""
+        res_real, res_imag = 0, 0
+        n_r, chunk = real.shape[-1], self.__hankel_chunk
+        for start in range(0, n_r, chunk):
+            end = min(start + chunk, n_r)
+            fn = functools.partial(self.__hankel_product, start, end)
+            args = (real[..., start:end], imag[..., start:end])
+            if torch.is_grad_enabled() and real.requires_grad:
+                block_real, block_imag = utils.checkpoint(fn, *args)
+            else:
+                block_real, block_imag = fn(*args)
+            res_real = res_real + block_real
+            res_imag = res_imag + block_imag
+        return res_real.squeeze(-2), res_imag.squeeze(-2)
+
     def __pointsource_inputfield1d(self, scene_distances):
         device = scene_distances.device
         r = self.aperture_pitch * torch.linspace(
@@ -35,7 +35,8 @@ class ZernikeApertureCamera(optics.classic.ClassicCamera):
         r = torch.sqrt(self.r2) / (self.aperture_diameter / 2)  # n_wl x N_u x N_v
         r = torch.clamp(r, 0, 1)
         t = torch.atan2(self.v_grid, self.u_grid)
-        self.register_buffer('mat', z.make_matrix(r, t, self.degree), persistent=False)
+        grid = ('pupil', tuple(self.r2.shape), self.aperture_diameter, tuple(self.interval.flatten().tolist()))
+        self.register_buffer('mat', z.make_matrix(r, t, self.degree, grid), persistent=False)
 
     def heightmap(self):
         h = z.fit_with_matrix(
@@ -50,7 +51,7 @@ class ZernikeApertureCamera(optics.classic.ClassicCamera):
         v = torch.linspace(-1, 1, 256)[..., None]
         r = torch.sqrt(u ** 2 + v ** 2)
         t = torch.atan2(v, u)
-        mat = z.make_matrix(r, t, self.degree)
+        mat = z.make_matrix(r, t, self.degree, ('square', 256, 256))
 
         u *= self.aperture_diameter / 2
         v *= self.aperture_diameter / 2
@@ -77,7 +78,7 @@ class ZernikeApertureCamera(optics.classic.ClassicCamera):
         h = utils.fold_profile(h, self.design_wavelength)
 
         phase = utils.heightmap2phase(h, wavelength, utils.refractive_index(wavelength))
-        return self.apply_stop(fft.exp2xy(1, phase), r2=torch.stack([r2, r2], -1))
+        return fft.polar(self.apply_stop(torch.ones_like(phase), r2=r2), phase, self.complex_backend)
 
     @torch.no_grad()
     def heightmap_log(self, size):
@@ -85,7 +86,8 @@ class ZernikeApertureCamera(optics.classic.ClassicCamera):
         v = torch.linspace(-1, 1, size[0])[:, None]
         r = torch.sqrt(u ** 2 + v ** 2)
         t = torch.atan2(v, u)
-        h = z.fit_with_matrix(z.make_matrix(r, t, self.degree), self.zernike_coefficients.cpu()[:, None])
+        m = z.make_matrix(r, t, self.degree, ('square', *size))
+        h = z.fit_with_matrix(m, self.zernike_coefficients.cpu()[:, None])
         h = utils.fold_profile(h, self.design_wavelength)
         h = torch.reshape(h, size)
         h -= h.min()
@@ -93,12 +95,12 @@ class ZernikeApertureCamera(optics.classic.ClassicCamera):
         return torch.where(torch.tensor(r < 1), h, torch.zeros_like(h)).unsqueeze(0)
 
     @classmethod
-    def extract_parameters(cls, **kwargs) -> typing.Dict:
+    def extract_parameters(cls, kwargs) -> typing.Dict:
         it = kwargs['initialization_type']
         if it not in ('default', 'lattice_focal'):
             raise ValueError(f'Unsupported initialization type: {it}')
 
-        base = super().extract_parameters(**kwargs)
+        base = super().extract_parameters(kwargs)
         base.update({
             'degree': kwargs['zernike_degree'],
         })
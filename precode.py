@@ -0,0 +1,28 @@
+import argparse
+
+import dataset
+import model as mod
+import utils
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='python %(prog)s ckpt_path sf_root out_dir [options]')
+    parser.add_argument('ckpt_path', type=str)
+    parser.add_argument('sf_root', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--split', type=str, default='val', help='"train" for train.py, "val" for evaluation')
+    parser.add_argument('--shard_size', type=int, default=256)
+    parser.add_argument('--batch_sz', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+
+    ckpt, hparams = utils.compatible_load(args.ckpt_path)
+    model = mod.RGBDImagingSystem.construct_from_checkpoint(ckpt)
+    size = hparams['image_sz'] + 4 * hparams['crop_width']
+    base = dataset.SceneFlow(
+        args.sf_root, args.split, (size, size),
+        is_training=False, n_depths=hparams['n_depths']
+    )
+    index = dataset.write_precoded_store(
+        args.out_dir, base, model, args.shard_size, args.batch_sz, args.num_workers
+    )
+    print(f'Coded {len(index["ids"])} images by optics {index["digest"]}')
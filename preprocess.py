@@ -0,0 +1,23 @@
+import argparse
+
+import dataset
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='python %(prog)s sf_root out_root [options]')
+    parser.add_argument('sf_root', type=str)
+    parser.add_argument('out_root', type=str)
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val'])
+    parser.add_argument('--padding', type=int, default=0)
+    parser.add_argument('--shard_size', type=int, default=512)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--range_cache', type=str, default=None, help='Also save disparity ranges to this file')
+    args = parser.parse_args()
+
+    if args.range_cache is not None:
+        dataset.build_disparity_ranges(args.sf_root, args.range_cache, args.splits)
+
+    for split in args.splits:
+        index = dataset.preprocess_sceneflow(
+            args.sf_root, args.out_root, split, args.padding, args.shard_size, args.num_workers
+        )
+        print(f'Preprocessed {len(index["ids"])} samples of {split}')
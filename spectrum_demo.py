@@ -9,7 +9,6 @@ import utils
 from optics.kernel import *
 from model.system import RGBDImagingSystem
 import utils.fft as fft
-import utils.old_complex as old_c
 import algorithm
 
 
@@ -19,9 +18,9 @@ pl.seed_everything(123)
 def focus_shift(original_aber, s, d, wavelength):
     def __focus_shift(u, v):
         phase = np.pi * s * (u ** 2 + v ** 2) / (wavelength * d)
-        return fft.exp2xy(1, phase)
+        return fft.polar(1, phase)
 
-    return lambda u, v: old_c.multiply(original_aber(u, v), __focus_shift(u, v))
+    return lambda u, v: fft.multiply(original_aber(u, v), __focus_shift(u, v))
 
 
 def load_trained_lens(ckpt_path) -> optics.DOECamera:
@@ -61,12 +60,12 @@ def predefined_lens_spectrum(delta0, f, d, aperture, wl, s, aber):
 def plain_lens_spectrum(delta0, f, d, aperture, wl, s):
     def __stop(u, v):
         r2 = u ** 2 + v ** 2
-        r2 = torch.stack([r2, r2], -1)
-        return torch.where(
+        amplitude = torch.where(
             torch.tensor(r2 < aperture ** 2 / 4),
             torch.ones_like(r2),
             torch.zeros_like(r2)
         )
+        return fft.polar(amplitude, torch.zeros_like(r2))
 
     return predefined_lens_spectrum(delta0, f, d, aperture, wl, s, __stop)
 
@@ -103,12 +102,12 @@ def lattice_focal_spectrum(
         else:
             phase = np.pi * slopemap * r2 / (wl * focal_depth)
 
-        r2 = torch.stack([r2, r2], -1)
-        return torch.where(
+        amplitude = torch.where(
             torch.tensor(r2 < aperture ** 2 / 4),
-            fft.exp2xy(1, phase),
+            torch.ones_like(r2),
             torch.zeros_like(r2)
         )
+        return fft.polar(amplitude, phase)
 
     return predefined_lens_spectrum(delta0, f, focal_depth, aperture, wl, 0, __lattice_focus_shift)
 
@@ -0,0 +1,55 @@
+import json
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.utils.data as data
+
+import dataset
+
+N_SAMPLES = 16
+WORLD_SIZE = 2
+
+
+class _Frames(data.Dataset):
+    def __len__(self):
+        return N_SAMPLES
+
+    def read_full(self, idx):
+        return dataset.ImageItem(f'{idx:04d}', torch.rand(3, 8, 8), torch.rand(1, 8, 8), torch.ones(1, 8, 8))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _stream(rank, root, port, out_dir):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=WORLD_SIZE)
+    # with a single slot buffer, an epoch yields exactly the shards of each worker
+    stream = dataset.ShardStream([root], (8, 8), buffer_size=1)
+    stream.set_epoch(0)
+    # spawned workers, as in train.py, do not see the process group
+    loader = data.DataLoader(stream, batch_size=None, num_workers=2, multiprocessing_context='spawn')
+    ids = [item.id for item in loader]
+    with open(os.path.join(out_dir, f'{rank}.json'), 'w') as f:
+        json.dump({'len': len(stream), 'ids': ids}, f)
+    dist.destroy_process_group()
+
+
+def test_ranks_stream_disjoint_samples(tmp_path):
+    root = str(tmp_path / 'shards')
+    dataset.write_tar_shards(_Frames(), root, shard_size=2, n_workers=2)
+    mp.spawn(_stream, args=(root, _free_port(), str(tmp_path)), nprocs=WORLD_SIZE)
+
+    results = []
+    for rank in range(WORLD_SIZE):
+        with open(tmp_path / f'{rank}.json') as f:
+            results.append(json.load(f))
+    for result in results:
+        assert result['len'] == N_SAMPLES // WORLD_SIZE
+        assert len(result['ids']) == N_SAMPLES // WORLD_SIZE
+    assert sorted(results[0]['ids'] + results[1]['ids']) == [f'{i:04d}' for i in range(N_SAMPLES)]
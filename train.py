@@ -13,7 +13,7 @@ from pytorch_lightning.loggers import TensorBoardLogger
 
 from dataset import *
 from model.system import RGBDImagingSystem
-from utils.log import LogManager
+from utils.log import LogManager, EpochSetter
 import utils
 
 pl.seed_everything(123)
@@ -31,11 +31,24 @@ def add_training_args(parser):
     parser.add_argument('--last_checkpoint', type=str, default='')
     parser.add_argument('--save_top', type=int, default=5)
     utils.add_switch(parser, 'mix_dualpixel_dataset', False, '')
+    parser.add_argument('--sf_npy_root', type=str, default=None, help='Root of preprocessed SceneFlow samples')
+    parser.add_argument('--sf_range_cache', type=str, default=None, help='File of SceneFlow disparity ranges')
+    parser.add_argument('--sf_shard_root', type=str, default=None,
+                        help='Root of SceneFlow tar shards, which are streamed for training if given')
+    parser.add_argument('--dp_shard_root', type=str, default=None, help='Root of DualPixel tar shards')
+    parser.add_argument('--shuffle_buffer', type=int, default=32, help='Size of shuffle buffer of streamed shards')
+    parser.add_argument('--dp_upsample_factor', type=int, default=1, help='Upsampling factor of DualPixel samples')
+    utils.add_switch(parser, 'dp_deferred_upsample', False,
+                     'Whether or not to upsample DualPixel samples in batch after collation rather than one by one')
+    parser.add_argument('--precoded_root', type=str, default=None,
+                        help='Store of captures of SceneFlow train split coded by precode.py with frozen optics')
+    utils.add_switch(parser, 'compact_transport', False, 'Whether or not to let data workers encode samples compactly')
+    utils.add_switch(parser, 'layer_labels', False, 'Whether or not to let data workers produce depth layer labels')
 
     return parser
 
 
-def prepare_data(hparams):
+def prepare_data(hparams, digest=None):
     image_sz = hparams.image_sz
     crop_width = hparams.crop_width
     augment = hparams.augment
@@ -46,29 +59,71 @@ def prepare_data(hparams):
 
     sceneflow = functools.partial(
         SceneFlow,
-        # PreCodedSceneFlow,
         '/home/ps/Data/Guojiaqi/dataset/sceneflow',
         'train',
         (image_sz + 4 * crop_width, image_sz + 4 * crop_width),
-        random_crop=randcrop, augment=augment, padding=padding
+        random_crop=randcrop, augment=augment, padding=padding,
+        n_depths=hparams.n_depths, layer_labels=hparams.layer_labels, npy_root=hparams.sf_npy_root,
+        range_cache=hparams.sf_range_cache,
+        raw=hparams.batch_augment, compact=hparams.compact_transport
     )
     dualpixel = functools.partial(
         DualPixel,
         '/home/ps/Data/Guojiaqi/dataset/dualpixel',
         image_size=(image_sz + 4 * crop_width, image_sz + 4 * crop_width),
-        random_crop=randcrop, augment=augment, padding=padding, upsample_factor=1
+        random_crop=randcrop, augment=augment, padding=padding, upsample_factor=hparams.dp_upsample_factor,
+        n_depths=hparams.n_depths, layer_labels=hparams.layer_labels, compact=hparams.compact_transport,
+        deferred_upsample=hparams.dp_deferred_upsample
     )
     dataloader = functools.partial(
         data.DataLoader,
-        batch_size=hparams.batch_sz, num_workers=hparams.num_workers, shuffle=False, pin_memory=True
+        batch_size=hparams.batch_sz, num_workers=hparams.num_workers, shuffle=False, pin_memory=True,
+        # DualPixel samples are left small by workers and upsampled in batch
+        collate_fn=UpsamplingCollate(
+            (image_sz + 4 * crop_width, image_sz + 4 * crop_width), hparams.n_depths
+        ) if hparams.dp_deferred_upsample else None
     )
 
-    sf_train_dataset = sceneflow(is_training=True)
+    if hparams.precoded_root is not None:
+        # only decoder is trained, on captures coded once by the optics of the store
+        if hparams.optimize_optics or randcrop or augment or hparams.batch_augment:
+            raise ValueError('Precoded captures require frozen optics and deterministic samples')
+        if hparams.mix_dualpixel_dataset or hparams.sf_shard_root is not None:
+            raise ValueError('Precoded captures are only available for SceneFlow dataset')
+        store = PreCodedStore(hparams.precoded_root, sceneflow(is_training=False), digest)
+        train_dataset = data.Subset(store, range(val_idx, len(store)))
+        val_dataset = data.Subset(store, range(val_idx))
+        return dataloader(train_dataset, shuffle=True), dataloader(val_dataset)
+
     sf_val_dataset = sceneflow(is_training=False)
-    sf_train_dataset = data.Subset(sf_train_dataset, range(val_idx, len(sf_train_dataset)))
     sf_val_dataset = data.Subset(sf_val_dataset, range(val_idx))
 
+    if hparams.sf_shard_root is not None:
+        # shards of training samples are written by make_shards.py
+        if hparams.batch_augment:
+            raise ValueError('Batch augmentation is not supported for streamed shards')
+        roots = [hparams.sf_shard_root]
+        val_dataset = sf_val_dataset
+        if hparams.mix_dualpixel_dataset:
+            if hparams.dp_shard_root is None:
+                raise ValueError('DualPixel shards are required to mix DualPixel dataset into streamed shards')
+            roots.insert(0, hparams.dp_shard_root)
+            val_dataset = data.ConcatDataset([dualpixel(partition='val', is_training=False), sf_val_dataset])
+
+        # sample each dataset with same probability
+        train_dataset = ShardStream(
+            roots, (image_sz + 4 * crop_width, image_sz + 4 * crop_width), random_crop=randcrop, augment=augment,
+            n_depths=hparams.n_depths, layer_labels=hparams.layer_labels, buffer_size=hparams.shuffle_buffer,
+            compact=hparams.compact_transport
+        )
+        return dataloader(train_dataset), dataloader(val_dataset)
+
+    sf_train_dataset = sceneflow(is_training=True)
+    sf_train_dataset = data.Subset(sf_train_dataset, range(val_idx, len(sf_train_dataset)))
+
     if hparams.mix_dualpixel_dataset:
+        if hparams.batch_augment:
+            raise ValueError('Batch augmentation is not supported for DualPixel dataset')
         dp_train_dataset = dualpixel(partition='train', is_training=True)
         dp_val_dataset = dualpixel(partition='val', is_training=False)
 
@@ -112,12 +167,17 @@ def main(args):
     )
 
     model = RGBDImagingSystem(hparams=args, log_dir=logger.log_dir)
-    train_dataloader, val_dataloader = prepare_data(args)
+    digest = optics_digest(model.camera, args) if args.precoded_root is not None else None
+    train_dataloader, val_dataloader = prepare_data(args, digest)
+
+    callbacks = [logmanager_callback, lr_log_callback]
+    if isinstance(train_dataloader.dataset, ShardStream):
+        callbacks.append(EpochSetter(train_dataloader.dataset))
 
     trainer = pl.Trainer.from_argparse_args(
         args,
         logger=logger,
-        callbacks=[logmanager_callback, lr_log_callback],
+        callbacks=callbacks,
         checkpoint_callback=checkpoint_callback,
         sync_batchnorm=True,
         benchmark=True,
@@ -1,12 +1,23 @@
+import math
 import warnings
 
 import torch
 
+import utils.old_complex as old_complex
+
 __fft = torch.fft
 import torch.fft as fft
 
 warnings.filterwarnings('ignore')
 
+# torch<1.8 provides torch.fft(), torch.rfft() and so on, which work on stacked real/imaginary pairs
+__has_old_fft = callable(__fft)
+
+# representations of complex fields in optics and image formation, selected per camera:
+# 'native' uses complex tensors and real-to-complex FFTs on half spectrum;
+# 'legacy' uses real tensors whose last dimension stacks real and imaginary parts
+complex_backends = ('native', 'legacy')
+
 
 def fftshift(x, dims=(-1, -2)):
     shifts = [(x.size(dim)) // 2 for dim in dims]
@@ -14,12 +25,70 @@ def fftshift(x, dims=(-1, -2)):
     return x
 
 
+def rfft_shift(size, device=None, dtype=torch.complex64) -> torch.Tensor:
+    """
+    Factor on half spectrum given by ``rfft2`` that equals ``fftshift`` in spatial domain after ``irfft2``.
+    :param size: Spatial size (H, W)
+    :return: Complex tensor in shape H x (W // 2 + 1)
+    """
+    h, w = size
+    kh = torch.arange(h, dtype=torch.float64, device=device).reshape(-1, 1) * (h // 2) / h
+    kw = torch.arange(w // 2 + 1, dtype=torch.float64, device=device).reshape(1, -1) * (w // 2) / w
+    return exp2complex(1, -2 * math.pi * torch.remainder(kh + kw, 1)).to(dtype)
+
+
+# torch.fft.*2 are not provided until torch 1.8
+
 def rfft2(x: torch.Tensor):
-    return fft.rfftn(x, x.shape[-2:])
+    return fft.rfftn(x, dim=(-2, -1))
 
 
 def irfft2(x, size):
-    return fft.irfftn(x, size)
+    return fft.irfftn(x, size, dim=(-2, -1))
+
+
+def fft2(x: torch.Tensor, backend='native'):
+    """2D DFT over the last two dimensions of a field in representation of ``backend``."""
+    if x.is_complex() or backend == 'native':
+        return fft.fftn(x, dim=(-2, -1))
+    return old_fft(x, 2)
+
+
+def ifft2(x: torch.Tensor, backend='native'):
+    if x.is_complex() or backend == 'native':
+        return fft.ifftn(x, dim=(-2, -1))
+    return old_ifft(x, 2)
+
+
+def polar(amplitude, phase, backend='native'):
+    """Construct field :math:`Ae^{i\\phi}` in representation of ``backend``."""
+    if backend == 'legacy':
+        return exp2xy(amplitude, phase)
+    return exp2complex(amplitude, phase)
+
+
+def multiply(x, y):
+    if x.is_complex():
+        return x * y
+    return old_complex.multiply(x, y)
+
+
+def conj(x):
+    if x.is_complex():
+        return x.conj()
+    return old_complex.conj(x)
+
+
+def abs2(x):
+    if x.is_complex():
+        return x.real.square() + x.imag.square()
+    return old_complex.abs2(x)
+
+
+def abs(x):
+    if x.is_complex():
+        return x.abs()
+    return old_complex.abs(x)
 
 
 def autocorrelation1d(x: torch.Tensor) -> torch.Tensor:
@@ -27,9 +96,96 @@ def autocorrelation1d(x: torch.Tensor) -> torch.Tensor:
     return res / res.max()
 
 
+def fold(x: torch.Tensor, factor: int, dims=(-2, -1)) -> torch.Tensor:
+    r"""
+    Alias a signal into a grid ``factor`` times smaller along each of ``dims``
+    by summing its periodic copies, i.e. :math:`y[p]=\sum_q x[p+qM]` where :math:`M=N/factor`.
+    The DFT of the result equals every ``factor``-th sample of the DFT of ``x``.
+    """
+    for dim in sorted(d % x.dim() for d in dims):
+        n = x.shape[dim]
+        if n % factor != 0:
+            raise ValueError(f'Size {n} of dimension {dim} is not divisible by {factor}')
+        x = x.reshape(*x.shape[:dim], factor, n // factor, *x.shape[dim + 1:]).sum(dim)
+    return x
+
+
+def next_fast_len(n: int) -> int:
+    """Smallest 5-smooth integer which is not less than n."""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def zoom_dft(x: torch.Tensor, start: float, step: float, m: int, dim=-1) -> torch.Tensor:
+    r"""
+    Evaluate :math:`X[k]=\sum_n x[n]e^{-2\pi i(f_0+k\Delta f)n}, 0\leq k<m` along ``dim``
+    of a complex tensor by Bluestein's chirp-Z algorithm. Its cost is that of FFTs
+    of length about :math:`N+m` no matter how densely the spectrum is sampled.
+    :param x: Complex tensor
+    :param start: :math:`f_0` in cycles per sample
+    :param step: :math:`\Delta f` in cycles per sample
+    :param m: Number of output samples
+    :param dim: Dimension to be transformed
+    :return: Complex tensor whose ``dim`` has size ``m``
+    """
+    x = x.transpose(dim, -1)
+    n = x.shape[-1]
+    length = next_fast_len(n + m - 1)
+
+    # chirp phases are reduced in double precision as step * k^2 can be large
+    k = torch.arange(max(n, m), dtype=torch.float64, device=x.device)
+    chirp = math.pi * torch.remainder(step * k ** 2, 2)
+    pre = exp2complex(1, -chirp[:n] - 2 * math.pi * torch.remainder(start * k[:n], 1)).to(x.dtype)
+    post = exp2complex(1, -chirp[:m]).to(x.dtype)
+    kernel = torch.zeros(length, dtype=x.dtype, device=x.device)
+    kernel[:m] = exp2complex(1, chirp[:m])
+    kernel[length - n + 1:] = exp2complex(1, torch.flip(chirp[1:n], (0,)))
+
+    y = fft.ifft(fft.fft(x * pre, length) * fft.fft(kernel), length)[..., :m] * post
+    return y.transpose(dim, -1)
+
+
+def exp2complex(amplitude, phase):
+    # cheaper in backward pass than torch.polar
+    return torch.complex(amplitude * torch.cos(phase), amplitude * torch.sin(phase))
+
+
 # the followings are implemented by torch.* rather than torch.fft.*
+# and fall back to torch.fft.* where the former have been removed
+
+def old_fft(x, signal_ndim):
+    if __has_old_fft:
+        return __fft(x, signal_ndim)
+    dims = tuple(range(-signal_ndim, 0))
+    return torch.view_as_real(fft.fftn(torch.view_as_complex(x.contiguous()), dim=dims))
+
+
+def old_ifft(x, signal_ndim):
+    if __has_old_fft:
+        return torch.ifft(x, signal_ndim)
+    dims = tuple(range(-signal_ndim, 0))
+    return torch.view_as_real(fft.ifftn(torch.view_as_complex(x.contiguous()), dim=dims))
+
+
+def old_rfft(x, signal_ndim, onesided=True):
+    if __has_old_fft:
+        return torch.rfft(x, signal_ndim, onesided=onesided)
+    dims = tuple(range(-signal_ndim, 0))
+    f = fft.rfftn(x, dim=dims) if onesided else fft.fftn(x, dim=dims)
+    return torch.view_as_real(f)
+
 
-old_fft = __fft
+def old_irfft(x, signal_ndim, signal_sizes):
+    if __has_old_fft:
+        return torch.irfft(x, signal_ndim, signal_sizes=signal_sizes)
+    dims = tuple(range(-signal_ndim, 0))
+    return fft.irfftn(torch.view_as_complex(x.contiguous()), s=signal_sizes, dim=dims)
 
 
 def exp2xy(amplitude, phase):
@@ -39,8 +195,8 @@ def exp2xy(amplitude, phase):
 
 
 def old_fft_exp(amplitude, phase):
-    return __fft(exp2xy(amplitude, phase), 2)
+    return old_fft(exp2xy(amplitude, phase), 2)
 
 
 def old_ifft_exp(amplitude, phase):
-    return torch.ifft(exp2xy(amplitude, phase), 2)
+    return old_ifft(exp2xy(amplitude, phase), 2)
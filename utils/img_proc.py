@@ -46,6 +46,54 @@ def to_bayer(x):
     return bayer
 
 
+def bayer_index(h, w, device=None):
+    """
+    Index of color channel sampled by each pixel of RGGB pattern used in ``to_bayer``,
+    so that mosaic can be gathered from an RGB image directly.
+    :return: Index with shape 1 x 1 x H x W
+    """
+    pattern = torch.tensor([[0, 1], [1, 2]], device=device)
+    return pattern.repeat((h + 1) // 2, (w + 1) // 2)[:h, :w].reshape(1, 1, h, w)
+
+
+def demosaic_kernels(dtype=torch.float32, device=None):
+    """Bilinear interpolation kernels from cross, diagonal, horizontal and vertical neighbours, in shape 4 x 1 x 3 x 3."""
+    return torch.tensor([
+        [[0, .25, 0], [.25, 0, .25], [0, .25, 0]],
+        [[.25, 0, .25], [0, 0, 0], [.25, 0, .25]],
+        [[0, 0, 0], [.5, 0, .5], [0, 0, 0]],
+        [[0, .5, 0], [0, 0, 0], [0, .5, 0]],
+    ], dtype=dtype, device=device).unsqueeze(1)
+
+
+def demosaic_index(h, w, device=None):
+    """
+    For each pixel of RGGB pattern and each color channel, index of kernel in ``demosaic_kernels``
+    to interpolate it with, where 4 means the pixel itself.
+    :return: Index with shape 1 x 3 x H x W
+    """
+    pattern = torch.tensor([
+        [[4, 2], [3, 1]],
+        [[0, 4], [4, 0]],
+        [[1, 3], [2, 4]],
+    ], device=device)
+    return pattern.repeat(1, (h + 1) // 2, (w + 1) // 2)[:, :h, :w].reshape(1, 3, h, w)
+
+
+def demosaic(bayer, kernels, index, out=None):
+    """
+    Bilinear demosaicing of RGGB mosaic, the same as ``debayer.Debayer3x3``.
+    :param bayer: Mosaic with shape B x 1 x H x W
+    :param kernels: Kernels given by ``demosaic_kernels``
+    :param index: Index given by ``demosaic_index``
+    :param out: Buffer with shape B x 5 x H x W for interpolated channels and mosaic,
+        which is not differentiable and allocated for each call if None
+    :return: RGB image with shape B x 3 x H x W
+    """
+    c = torch.nn.functional.conv2d(torch.nn.functional.pad(bayer, [1, 1, 1, 1], mode='reflect'), kernels)
+    return torch.gather(torch.cat([c, bayer], 1, out=out), 1, index.expand(bayer.shape[0], -1, -1, -1))
+
+
 def ips_to_metric(d, min_depth, max_depth):
     """
     https://github.com/fyu/tiny/blob/4572a056fd92696a3a970c2cffd3ba1dae0b8ea0/src/sweep_planes.cc#L204
@@ -20,3 +20,14 @@ class LogManager(Callback):
             ckpt_path = os.path.join(trainer.logger.log_dir, 'checkpoints', 'interrupted_model.ckpt')
             trainer.save_checkpoint(ckpt_path)
             print('Saved a checkpoint...')
+
+
+class EpochSetter(Callback):
+    def __init__(self, dataset):
+        """
+        Pass current epoch to a dataset by its ``set_epoch`` before every training epoch, e.g. ``ShardStream``.
+        """
+        self.__dataset = dataset
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.__dataset.set_epoch(trainer.current_epoch)
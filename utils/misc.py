@@ -8,6 +8,21 @@ def compatible_load(ckpt_path: str):
     hparams.setdefault('estimator_type', 'unet')
     hparams.setdefault('unet_channels', None)
     hparams.setdefault('network_lr', 1e-3)
+    hparams.setdefault('psf_mode', 'full')
+    hparams.setdefault('psf_window', 0)
+    hparams.setdefault('complex_backend', 'native')
+    hparams.setdefault('precision', None)
+    hparams.setdefault('defocus_tolerance', 0)
+    hparams.setdefault('bspline_banded', True)
+    hparams.setdefault('hankel_chunk', 0)
+    hparams.setdefault('image_formation', 'fft')
+    hparams.setdefault('tile_size', 256)
+    hparams.setdefault('support_tolerance', 1e-4)
+    hparams.setdefault('prune_layers', True)
+    hparams.setdefault('layer_chunk', 0)
+    hparams.setdefault('fused_sensor', False)
+    hparams.setdefault('shot_noise', 0.)
+    hparams.setdefault('batch_augment', False)
 
     hparams['init_network'] = ''
     hparams['init_optics'] = ''
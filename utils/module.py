@@ -1,9 +1,14 @@
 from typing import OrderedDict, Callable
 import collections
+import inspect
 import warnings
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
+
+# torch<1.11 provides reentrant checkpointing only
+__has_nonreentrant = 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint).parameters
 
 
 def init_module(module: nn.Module):
@@ -56,3 +61,13 @@ def load_state_dict_unstrict(module: nn.Module, state_dict):
             f'Unexpected keys: {result.unexpected_keys}',
             RuntimeWarning
         )
+
+
+def checkpoint(fn: Callable, *args):
+    """
+    Run ``fn`` on ``args`` by ``torch.utils.checkpoint.checkpoint``, non-reentrant where it is provided,
+    which backpropagates to parameters used in ``fn`` even if no input requires grad.
+    """
+    if __has_nonreentrant:
+        return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False)
+    return torch.utils.checkpoint.checkpoint(fn, *args)
@@ -34,6 +34,61 @@ def depthmap2layers(depthmap, n_depths, binary=False):
     return alpha
 
 
+def depthmap2labels(depthmap, n_depths, binary=False):
+    """
+    Compact form of ``depthmap2layers`` which stores index of the layer each pixel belongs to
+    rather than dense alpha of all layers.
+    :param depthmap: Depth map with shape ... x H x W in [0, 1]
+    :param n_depths: Number of depth layers, no more than 255
+    :param binary: Whether alpha is binary
+    :return: Layer labels in uint8 with the same shape as depthmap, and fractional weight of
+        the layer in front of labelled one (None if binary), so that alpha of layer ``labels``
+        is 1 and that of layer ``labels - 1`` is ``weight``
+    """
+    if n_depths > 255:
+        raise ValueError(f'Too many depth layers for uint8 labels: {n_depths}')
+    depthmap = depthmap.clamp(1e-8, 1.0) * n_depths
+    if binary:
+        return (torch.ceil(depthmap) - 1).to(torch.uint8), None
+    labels = torch.floor(depthmap).clamp_max(n_depths - 1)
+    return labels.to(torch.uint8), labels + 1 - depthmap
+
+
+def labels2layers(labels, index, weight=None, cumulative=False, dtype=torch.float32):
+    r"""
+    Expand labels given by ``depthmap2labels`` into alpha of some layers.
+    :param labels: Layer labels with shape B x H x W or B x 1 x H x W
+    :param index: Indices of layers to be expanded, a 1D tensor
+    :param weight: Fractional weight of layer in front of labelled one, optional
+    :param cumulative: Whether to expand cumulative alpha :math:`\sum_{d'\geq d}\alpha_{d'}` instead
+    :param dtype: Data type of alpha
+    :return: Alpha with shape B x 1 x len(index) x H x W
+    """
+    if labels.ndim == 3:
+        labels = labels.unsqueeze(1)
+        weight = None if weight is None else weight.unsqueeze(1)
+    labels = labels.unsqueeze(2).long()
+    d = index.reshape(1, 1, -1, 1, 1).to(labels.device)
+    if cumulative:
+        alpha = (labels >= d).to(dtype)
+        if weight is not None:
+            alpha = alpha + weight.unsqueeze(2).to(dtype) * (labels > d)
+    else:
+        alpha = (labels == d).to(dtype)
+        if weight is not None:
+            alpha = alpha + weight.unsqueeze(2).to(dtype) * (labels == d + 1)
+    return alpha
+
+
+def occupied_labels(labels, weight=None):
+    """Sorted indices of layers with nonzero alpha for any pixel of labels given by ``depthmap2labels``."""
+    index = torch.unique(labels).long()
+    if weight is not None:
+        index = torch.unique(torch.cat([index, torch.unique(labels[weight > 0]).long() - 1]))
+        index = index[index >= 0]
+    return index
+
+
 def fold_profile(profile, wavelength, n=1):
     thichness = n * wavelength / (refractive_index(wavelength) - 1)
 
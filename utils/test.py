@@ -20,10 +20,12 @@ import pytorch_ssim
 import numpy as np
 
 import model as mod
+import dataset as ds
 import utils
 
 __sf: Any = None
 __dp: Any = None
+__precoded: Any = None
 __floatfmt = '.4g'
 __greater_better = ('img_psnr', 'img_ssim')
 __metrics = {
@@ -53,18 +55,17 @@ def __select_imgs(img_path, batch_sz):
 
 
 def __init_dataset(hparams):
-    import dataset
     global __sf, __dp
     image_sz = hparams['image_sz']
     crop_width = hparams['crop_width']
     padding = hparams.get('padding', 0)
-    __sf = dataset.SceneFlow(
+    __sf = ds.SceneFlow(
         '/home/ps/Data/Guojiaqi/dataset/sceneflow',
         'val',
         (image_sz + 4 * crop_width, image_sz + 4 * crop_width),
         random_crop=False, augment=False, padding=padding, is_training=False
     )
-    __dp = dataset.DualPixel(
+    __dp = ds.DualPixel(
         '/home/ps/Data/Guojiaqi/dataset/dualpixel',
         image_size=(image_sz + 4 * crop_width, image_sz + 4 * crop_width),
         random_crop=False, augment=False, padding=padding, upsample_factor=1,
@@ -138,10 +139,10 @@ def get_item(dataset, img_ids, device='cpu'):
     :param dataset: 'sceneflow' or 'dualpixel'
     :param img_ids: Iterable of int
     :param device: device
-    :return: 2-tuple, image batch and depth map batch
+    :return: 3-tuple, image batch, depth map batch and precoded capture batch (None if not precoded)
     """
     if dataset == 'sceneflow':
-        val_dataset = __sf
+        val_dataset = __sf if __precoded is None else __precoded
     elif dataset == 'dualpixel':
         val_dataset = __dp
     else:
@@ -150,12 +151,16 @@ def get_item(dataset, img_ids, device='cpu'):
     items = list(map(lambda i: val_dataset[i], img_ids))
     imgs = torch.stack(list(map(lambda item: item[1], items)))
     depthmaps = torch.stack(list(map(lambda item: item[2], items)))
-    return imgs.to(device), depthmaps.to(device)
+    if len(items[0]) == 5:
+        precoded = torch.stack(list(map(lambda item: item[4], items))).to(device)
+    else:
+        precoded = None
+    return imgs.to(device), depthmaps.to(device), precoded
 
 
 @torch.no_grad()
 def eval_checkpoint(metrics, ckpt_path, override=None, **kwargs):
-    global __sf, __dp
+    global __sf, __dp, __precoded
     device = torch.device(kwargs.get('device', 'cpu'))
     apply_noise = kwargs['noise'] == 'standard'
 
@@ -174,6 +179,12 @@ def eval_checkpoint(metrics, ckpt_path, override=None, **kwargs):
     model = model.to(device)
     model.eval()
 
+    # captures coded by other optics than the checkpoint's are rejected by digest
+    if kwargs.get('precoded_root'):
+        __precoded = ds.PreCodedStore(kwargs['precoded_root'], __sf, ds.optics_digest(model.camera, model.hparams))
+    else:
+        __precoded = None
+
     dataset, img_ids = __select_imgs(kwargs['img_path'], kwargs['batch_sz'])
 
     metric_values = {m: 0 for m in metrics}
@@ -186,7 +197,7 @@ def eval_checkpoint(metrics, ckpt_path, override=None, **kwargs):
         item = get_item(dataset, batch, str(device))
         losses = {m: 0 for m in metrics}
         for _ in range(repetition):
-            output: mod.FinalOutput = model(item[0], item[1], False)
+            output: mod.FinalOutput = model(item[0], item[1], False, precoded=item[2])
             est_depthmap = output.est_depthmap * (hparams['max_depth'] - hparams['min_depth'])
             target_depthmap = output.target_depthmap * (hparams['max_depth'] - hparams['min_depth'])
 
@@ -269,6 +280,8 @@ def config_args():
     parser.add_argument('--criterion', type=str, default='norm')
     parser.add_argument('--noise', type=str, default='')
     parser.add_argument('--dump_record', default=False, action='store_true')
+    parser.add_argument('--precoded_root', type=str, default=None,
+                        help='Store of captures of SceneFlow val split coded by precode.py, evaluated instead of coding')
 
     return parser
 